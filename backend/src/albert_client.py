@@ -0,0 +1,367 @@
+"""
+Resilient client for the Albert API.
+
+Every call to Albert goes through an AlbertClient, which gives each endpoint
+(collections, search, files, chat) its own:
+-  adaptive concurrency limit (AIMD on latency and errors) with a bounded wait queue,
+-  timeout,
+-  retry with exponential backoff and full jitter, for idempotent calls only,
+-  circuit breaker that fails fast while the upstream is degraded.
+
+When the wait queue of an endpoint is full, the call is shed immediately with an
+OverloadedError, which install_error_handlers turns into a 503 for the FastAPI apps.
+"""
+
+import math
+import asyncio
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import openai
+from openai import OpenAI
+from fastapi.responses import JSONResponse
+
+###########################
+# ENV CONSTS
+DEBUG = True
+
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+UPSTREAM_THREADS = 64 # Threads waiting on Albert, kept apart from the default executor used for file I/O
+
+
+###########################
+# Errors
+class UpstreamError(Exception):
+    """The Albert API failed or answered with an unexpected status code."""
+    def __init__(self, endpoint: str, message: str, status_code: int = None):
+        super().__init__(f"Albert '{endpoint}' call failed: {message}")
+        self.endpoint = endpoint
+        self.status_code = status_code
+
+
+class CircuitOpenError(UpstreamError):
+    """The circuit breaker of the endpoint is open, the call was not attempted."""
+    def __init__(self, endpoint: str, message: str, retry_after: float = 1.0):
+        super().__init__(endpoint, message)
+        self.retry_after = retry_after # Seconds until the next probe call is let through
+
+
+class OverloadedError(Exception):
+    """Our own wait queue for the endpoint is full, the call was shed."""
+    def __init__(self, endpoint: str, retry_after: float = 1.0):
+        super().__init__(f"Too many pending '{endpoint}' calls to the Albert API, please retry later.")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+###########################
+# Per-endpoint policies
+class EndpointPolicy:
+    def __init__(
+        self,
+        timeout: float = 30.0,
+        max_attempts: int = 3,
+        backoff_base: float = 0.2,
+        backoff_max: float = 5.0,
+        initial_limit: int = 8,
+        min_limit: int = 1,
+        max_limit: int = 64,
+        max_queue: int = 64,
+        queue_timeout: float = 10.0,
+        latency_tolerance: float = 2.0,
+        shrink_on_latency: bool = True,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+    ):
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.latency_tolerance = latency_tolerance
+        self.shrink_on_latency = shrink_on_latency # False when latency depends on the request (e.g. answer length)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+
+DEFAULT_POLICIES = {
+    "collections": EndpointPolicy(timeout=10.0),
+    "search": EndpointPolicy(timeout=15.0),
+    "files": EndpointPolicy(timeout=120.0, initial_limit=2, max_limit=8),
+    # Completion time grows with the answer length, so only errors, 429s and timeouts shrink the limit
+    "chat": EndpointPolicy(timeout=120.0, max_attempts=1, initial_limit=4, max_limit=32, shrink_on_latency=False),
+}
+
+
+###########################
+# Adaptive concurrency limit
+class AdaptiveLimiter:
+    """
+    Concurrency limit that grows additively while latency stays close to the best
+    recently observed latency, and shrinks multiplicatively on slow calls and failures.
+    Like TCP, it grows by one per call (slow start) until the first decrease.
+    Callers above the limit wait in a bounded FIFO queue.
+    """
+    def __init__(self, name: str, policy: EndpointPolicy):
+        self.name = name
+        self.policy = policy
+        self.limit = float(policy.initial_limit)
+        self.inflight = 0
+        self._waiters = deque()
+        self._latencies = deque(maxlen=100)
+        self._slow_start = True
+
+    async def acquire(self, timeout: float = None):
+        """Take a slot, waiting at most queue_timeout (or timeout, if shorter) in the queue."""
+        if self.inflight < int(self.limit) and not self._waiters:
+            self.inflight += 1
+            return
+
+        if len(self._waiters) >= self.policy.max_queue:
+            raise OverloadedError(self.name)
+
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await asyncio.wait_for(future, self.policy.queue_timeout if timeout is None else min(self.policy.queue_timeout, timeout))
+        except asyncio.TimeoutError:
+            raise OverloadedError(self.name)
+        except BaseException:
+            # The slot may have been granted right before we got cancelled
+            if future.done() and not future.cancelled():
+                self.inflight -= 1
+                self._wake()
+            raise
+        finally:
+            if future in self._waiters:
+                self._waiters.remove(future)
+
+    def release(self, latency: float, ok: bool = None):
+        """Free the slot and adapt the limit, ok=None frees it without adapting (the caller gave up)."""
+        self.inflight -= 1
+
+        if ok is None:
+            pass
+        elif ok:
+            self._latencies.append(latency)
+            baseline = min(self._latencies)
+            if not self.policy.shrink_on_latency or latency <= baseline * self.policy.latency_tolerance:
+                self.limit = min(self.policy.max_limit, self.limit + (1 if self._slow_start else 1 / self.limit))
+            else:
+                self.limit = max(self.policy.min_limit, self.limit * 0.9)
+                self._slow_start = False
+        else:
+            self.limit = max(self.policy.min_limit, self.limit * 0.5)
+            self._slow_start = False
+
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.inflight < int(self.limit):
+            future = self._waiters.popleft()
+            if not future.done():
+                self.inflight += 1
+                future.set_result(None)
+
+
+###########################
+# Circuit breaker
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures, then lets a single probe
+    call through every `reset_timeout` seconds until one succeeds.
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, policy: EndpointPolicy):
+        self.name = name
+        self.policy = policy
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    def before_call(self):
+        if self.state == self.CLOSED:
+            return
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.policy.reset_timeout:
+            # Let this call through as the probe, the others keep failing fast
+            self.state = self.HALF_OPEN
+            return
+        retry_after = self.policy.reset_timeout - (time.monotonic() - self.opened_at)
+        raise CircuitOpenError(self.name, "circuit open, upstream is degraded", max(retry_after, 0.0))
+
+    def abort_probe(self):
+        """The probe call never reached the upstream, let the next call probe instead."""
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+            self.opened_at = time.monotonic() - self.policy.reset_timeout
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.policy.failure_threshold:
+            if DEBUG and self.state != self.OPEN: print(f"Circuit for Albert '{self.name}' opened.")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+###########################
+# Client
+class AlbertClient:
+    def __init__(self, base_url: str, api_key: str, policies: dict = None):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.policies = dict(DEFAULT_POLICIES)
+        if policies is not None:
+            self.policies.update(policies)
+        self.limiters = dict()
+        self.breakers = dict()
+
+        self.session = requests.session()
+        self.session.headers = {"Authorization": f"Bearer {api_key}"}
+        # One pooled connection per worker thread, the default pool keeps only 10
+        adapter = requests.adapters.HTTPAdapter(pool_connections=UPSTREAM_THREADS, pool_maxsize=UPSTREAM_THREADS)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._openai = None
+        self._executor = ThreadPoolExecutor(max_workers=UPSTREAM_THREADS, thread_name_prefix="albert")
+
+    def _policy(self, endpoint: str):
+        if endpoint not in self.policies:
+            self.policies[endpoint] = EndpointPolicy()
+        if endpoint not in self.limiters:
+            self.limiters[endpoint] = AdaptiveLimiter(endpoint, self.policies[endpoint])
+            self.breakers[endpoint] = CircuitBreaker(endpoint, self.policies[endpoint])
+        return self.policies[endpoint], self.limiters[endpoint], self.breakers[endpoint]
+
+    async def call(self, endpoint: str, fn, idempotent: bool, deadline: float = None):
+        """
+        Run the blocking `fn(timeout)` in a worker thread under the endpoint limit,
+        circuit breaker and retry policy. Only idempotent calls are retried.
+        With a deadline (in seconds), queue waits, attempt timeouts and retries are cut to fit in it.
+        The timeout given to fn bounds each socket read, callers needing a hard bound wrap the call
+        in asyncio.wait_for.
+        """
+        policy, limiter, breaker = self._policy(endpoint)
+        attempts = policy.max_attempts if idempotent else 1
+        end = time.monotonic() + deadline if deadline is not None else None
+
+        for attempt in range(attempts):
+            if end is not None and end - time.monotonic() <= 0:
+                raise UpstreamError(endpoint, f"deadline of {deadline}s exceeded")
+            breaker.before_call()
+            try:
+                await limiter.acquire(None if end is None else end - time.monotonic())
+            except BaseException:
+                breaker.abort_probe()
+                raise
+
+            # The time waited in the queue counts against the deadline
+            timeout = policy.timeout if end is None else min(policy.timeout, end - time.monotonic())
+            if timeout <= 0:
+                limiter.release(0.0, ok=None)
+                breaker.abort_probe()
+                raise UpstreamError(endpoint, f"deadline of {deadline}s exceeded")
+
+            start = time.monotonic()
+            future = asyncio.get_running_loop().run_in_executor(self._executor, fn, timeout)
+            try:
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # The worker thread still waits on Albert, its slot is freed once it is done
+                future.add_done_callback(lambda f: self._abandoned_done(endpoint, f))
+                raise
+            except Exception as e:
+                retryable, error = self._classify(endpoint, e)
+                # The upstream answered when the call is not retryable, the request itself is at fault
+                limiter.release(time.monotonic() - start, ok=not retryable)
+                if not retryable:
+                    breaker.record_success()
+                    raise error from e
+                breaker.record_failure()
+                if attempt + 1 == attempts or (end is not None and time.monotonic() >= end):
+                    raise error from e
+            else:
+                limiter.release(time.monotonic() - start, ok=True)
+                breaker.record_success()
+                return result
+
+            delay = random.uniform(0, min(policy.backoff_max, policy.backoff_base * 2 ** attempt))
+            if end is not None:
+                delay = min(delay, max(0.0, end - time.monotonic()))
+            if DEBUG: print(f"Albert '{endpoint}' call failed, retrying in {delay:.2f}s...")
+            await asyncio.sleep(delay)
+
+    def _abandoned_done(self, endpoint: str, future):
+        """A call whose caller was cancelled finished: free its slot and record its outcome."""
+        _, limiter, breaker = self._policy(endpoint)
+        limiter.release(0.0, ok=None)
+        if future.cancelled():
+            breaker.abort_probe()
+        elif future.exception() is None or not self._classify(endpoint, future.exception())[0]:
+            breaker.record_success()
+        else:
+            breaker.record_failure()
+
+    def _classify(self, endpoint: str, e: Exception):
+        """Return (retryable, UpstreamError) for an exception raised by a call."""
+        if isinstance(e, UpstreamError):
+            return e.status_code in RETRYABLE_STATUS_CODES, e
+        if isinstance(e, (requests.Timeout, requests.ConnectionError, openai.APITimeoutError, openai.APIConnectionError)):
+            return True, UpstreamError(endpoint, f"{type(e).__name__}: {e}")
+        if isinstance(e, openai.APIStatusError):
+            return e.status_code in RETRYABLE_STATUS_CODES, UpstreamError(endpoint, str(e), e.status_code)
+        return False, UpstreamError(endpoint, f"{type(e).__name__}: {e}")
+
+    async def request(self, endpoint: str, method: str, path: str, expected_status=(200,), idempotent: bool = None, deadline: float = None, **kwargs):
+        """
+        Send an HTTP request to `BASE_URL + path` and return the requests.Response.
+        GET, PUT and DELETE are retried by default, pass idempotent=True for POSTs that are safe to replay.
+        """
+        if idempotent is None:
+            idempotent = method.upper() in ("GET", "HEAD", "PUT", "DELETE")
+
+        def send(timeout):
+            response = self.session.request(method, f"{self.base_url}{path}", timeout=timeout, **kwargs)
+            if response.status_code not in expected_status:
+                raise UpstreamError(endpoint, f"{response.status_code} - {response.text[:200]}", response.status_code)
+            return response
+
+        return await self.call(endpoint, send, idempotent, deadline)
+
+    async def chat_completion(self, **data):
+        """Call /chat/completions through the OpenAI client. Completions are never retried."""
+        if self._openai is None:
+            self._openai = OpenAI(base_url=self.base_url, api_key=self.api_key, max_retries=0)
+
+        def send(timeout):
+            return self._openai.chat.completions.create(timeout=timeout, **data)
+
+        return await self.call("chat", send, idempotent=False)
+
+
+###########################
+# FastAPI integration
+def install_error_handlers(app):
+    """Map resilience errors to HTTP responses: 503 when shedding or failing fast, 502 otherwise."""
+    @app.exception_handler(OverloadedError)
+    async def overloaded_handler(request, exc: OverloadedError):
+        return JSONResponse(status_code=503, content={"response": str(exc)}, headers={"Retry-After": str(int(exc.retry_after))})
+
+    @app.exception_handler(CircuitOpenError)
+    async def circuit_open_handler(request, exc: CircuitOpenError):
+        return JSONResponse(status_code=503, content={"response": str(exc)}, headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))})
+
+    @app.exception_handler(UpstreamError)
+    async def upstream_handler(request, exc: UpstreamError):
+        return JSONResponse(status_code=502, content={"response": str(exc)})
@@ -0,0 +1,278 @@
+"""
+Local stand-in for the subset of the Albert API used by api_rag and api_basic:
+/collections, /documents, /chunks, /search, /files and /chat/completions (including streaming).
+
+Every call waits a configurable latency and fails with a configurable probability,
+so the backend can be load tested offline. Point the apps at it with:
+    ALBERT_BASE_URL=http://localhost:8100/v1
+
+The latency and error injection can be changed while running with POST /v1/_stub/config.
+"""
+
+import asyncio
+import io
+import json
+import random
+import time
+import argparse
+from email import policy
+from email.parser import BytesParser
+
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+from pypdf import PdfReader
+import uvicorn
+
+###########################
+# ENV CONSTS
+DEBUG = False
+PORT = 8100
+
+DEFAULT_LATENCIES = {
+    "collections": 0.02,
+    "search": 0.1,
+    "files": 0.2,
+    "chat": 0.8,
+}
+
+STUB_ANSWER = "This is a stub answer from the local Albert stand-in, it does not know anything about your courses."
+
+###########################
+# Stub state
+class StubConfig(BaseModel):
+    latencies: dict = dict(DEFAULT_LATENCIES) # Mean latency in seconds for each endpoint
+    jitter: float = 0.2 # Latency is drawn uniformly in mean * (1 +- jitter)
+    error_rate: float = 0.0 # Probability of answering with error_status instead
+    error_status: int = 503
+    stream_chunks: int = 10 # Number of chunks sent when streaming a completion
+
+config = StubConfig()
+collections = dict() # collection id -> {"id", "name", "documents": [document ids]}
+documents = dict() # document id -> {"id", "name", "collection", "chunks": [chunk dicts]}
+next_ids = {"collection": 1, "document": 1, "completion": 1}
+
+def new_id(kind: str):
+    next_ids[kind] += 1
+    return next_ids[kind] - 1
+
+def add_document(collection_id: int, name: str, chunk_count: int = 5, contents: list = None):
+    document_id = new_id("document")
+    if contents is None:
+        contents = [f"Stub content of {name}, part {i + 1}. " * 8 for i in range(chunk_count)]
+    # Like Albert, chunks are numbered within their document
+    chunks = []
+    for i, content in enumerate(contents):
+        chunks.append({
+            "id": i + 1,
+            "content": content,
+            "metadata": {"document_name": name, "document_id": document_id, "collection_id": collection_id},
+        })
+    documents[document_id] = {"id": document_id, "name": name, "collection": collection_id, "chunks": chunks}
+    collections[collection_id]["documents"].append(document_id)
+    return document_id
+
+def chunk_pdf(content: bytes, chunk_size: int = 500):
+    """Split the text of a PDF into chunks of about chunk_size characters, or None if it has no text."""
+    try:
+        text = "\n".join(page.extract_text() for page in PdfReader(io.BytesIO(content)).pages)
+    except Exception:
+        return None
+    chunks, current = [], ""
+    for word in text.split():
+        current += word + " "
+        if len(current) >= chunk_size:
+            chunks.append(current.strip())
+            current = ""
+    if current.strip():
+        chunks.append(current.strip())
+    return chunks or None
+
+def seed(collection_name: str = "moodle_pdfs_0", document_count: int = 20):
+    """Create a collection filled with synthetic documents so /search answers out of the box."""
+    collection_id = new_id("collection")
+    collections[collection_id] = {"id": collection_id, "name": collection_name, "documents": []}
+    for i in range(document_count):
+        add_document(collection_id, f"stub_document_{i}.pdf")
+    return collection_id
+
+###########################
+# Latency and error injection
+app = FastAPI()
+
+async def inject(endpoint: str):
+    """Wait the endpoint latency, then return an error response or None."""
+    latency = config.latencies.get(endpoint, 0.0)
+    await asyncio.sleep(max(0.0, latency * random.uniform(1 - config.jitter, 1 + config.jitter)))
+    if random.random() < config.error_rate:
+        if DEBUG: print(f"Injecting a {config.error_status} on '{endpoint}'")
+        return JSONResponse(status_code=config.error_status, content={"detail": "Injected error from the Albert stub"})
+    return None
+
+###########################
+# Endpoints
+@app.get("/v1/collections")
+async def list_collections(offset: int = 0, limit: int = 100):
+    error = await inject("collections")
+    if error: return error
+    data = [{"object": "collection", "id": c["id"], "name": c["name"], "documents": len(c["documents"])} for c in collections.values()]
+    return {"object": "list", "data": data[offset:offset + limit]}
+
+@app.post("/v1/collections", status_code=201)
+async def create_collection(request: Request):
+    error = await inject("collections")
+    if error: return error
+    body = await request.json()
+    collection_id = new_id("collection")
+    collections[collection_id] = {"id": collection_id, "name": body["name"], "documents": []}
+    return {"id": collection_id}
+
+@app.delete("/v1/collections/{collection_id}")
+async def delete_collection(collection_id: int):
+    error = await inject("collections")
+    if error: return error
+    if collection_id not in collections:
+        return JSONResponse(status_code=404, content={"detail": "Collection not found"})
+    for document_id in collections.pop(collection_id)["documents"]:
+        documents.pop(document_id, None)
+    return Response(status_code=204)
+
+@app.get("/v1/documents")
+async def list_documents(collection: int, offset: int = 0, limit: int = 10):
+    error = await inject("collections")
+    if error: return error
+    if collection not in collections:
+        return JSONResponse(status_code=404, content={"detail": "Collection not found"})
+    data = [{"object": "document", "id": d, "name": documents[d]["name"], "collection_id": collection, "chunks": len(documents[d]["chunks"])} for d in collections[collection]["documents"]]
+    return {"object": "list", "data": data[offset:offset + limit]}
+
+@app.delete("/v1/documents/{document_id}")
+async def delete_document(document_id: int):
+    error = await inject("collections")
+    if error: return error
+    if document_id not in documents:
+        return JSONResponse(status_code=404, content={"detail": "Document not found"})
+    document = documents.pop(document_id)
+    collections[document["collection"]]["documents"].remove(document_id)
+    return Response(status_code=204)
+
+@app.post("/v1/files", status_code=201)
+async def upload_file(request: Request):
+    error = await inject("files")
+    if error: return error
+
+    # Parse the multipart form by hand, to avoid requiring python-multipart
+    raw = f"Content-Type: {request.headers['content-type']}\r\n\r\n".encode() + await request.body()
+    file_name, collection_id, contents = "upload.pdf", None, None
+    for part in BytesParser(policy=policy.default).parsebytes(raw).iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        if name == "file":
+            file_name = part.get_filename() or file_name
+            contents = chunk_pdf(part.get_payload(decode=True))
+        elif name == "request":
+            collection_id = int(json.loads(part.get_payload(decode=True))["collection"])
+
+    if collection_id not in collections:
+        return JSONResponse(status_code=404, content={"detail": "Collection not found"})
+    return {"id": add_document(collection_id, file_name, contents=contents)}
+
+@app.get("/v1/chunks/{document_id}")
+async def list_chunks(document_id: int, offset: int = 0, limit: int = 10):
+    error = await inject("search")
+    if error: return error
+    if document_id not in documents:
+        return JSONResponse(status_code=404, content={"detail": "Document not found"})
+    return {"object": "list", "data": documents[document_id]["chunks"][offset:offset + limit]}
+
+@app.post("/v1/search")
+async def search(request: Request):
+    error = await inject("search")
+    if error: return error
+    body = await request.json()
+
+    # Deterministic pseudo-scores so the same prompt always gives the same chunks
+    rng = random.Random(body.get("prompt", ""))
+    results = []
+    for collection_id in body.get("collections", []):
+        for document_id in collections.get(int(collection_id), {"documents": []})["documents"]:
+            for chunk in documents[document_id]["chunks"]:
+                results.append({"method": "semantic", "score": rng.uniform(0.3, 0.95), "chunk": chunk})
+    results.sort(key=lambda result: result["score"], reverse=True)
+    return {"object": "list", "data": results[:body.get("k", 5)]}
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    error = await inject("chat")
+    if error: return error
+    body = await request.json()
+    completion_id = f"chatcmpl-stub-{new_id('completion')}"
+    created = int(time.time())
+    prompt_chars = sum(len(str(message.get("content", ""))) for message in body.get("messages", []))
+    usage = {"prompt_tokens": prompt_chars // 4, "completion_tokens": len(STUB_ANSWER) // 4, "total_tokens": (prompt_chars + len(STUB_ANSWER)) // 4}
+
+    if not body.get("stream", False):
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": body.get("model", "stub"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": STUB_ANSWER}, "finish_reason": "stop"}],
+            "usage": usage,
+        }
+
+    async def stream():
+        # The configured latency is the time to first token, generating the rest takes as long again
+        words = STUB_ANSWER.split(" ")
+        step = -(-len(words) // config.stream_chunks)
+        for i in range(0, len(words), step):
+            delta = {"content": " ".join(words[i:i + step]) + (" " if i + step < len(words) else "")}
+            if i == 0: delta["role"] = "assistant"
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": body.get("model", "stub"),
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": None}]}
+            yield f"data: {json.dumps(chunk)}\n\n"
+            await asyncio.sleep(config.latencies.get("chat", 0.0) / config.stream_chunks)
+        chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": body.get("model", "stub"),
+                 "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+        yield f"data: {json.dumps(chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+@app.post("/v1/_stub/config")
+async def update_config(new_config: StubConfig):
+    global config
+    config = new_config
+    return config
+
+@app.get("/v1/_stub/config")
+async def get_config():
+    return config
+
+###########################
+# Run the stub
+def parse_latencies(values: list):
+    """Parse ["chat=0.5", "search=0.05"] into a latency dict on top of the defaults."""
+    latencies = dict(DEFAULT_LATENCIES)
+    for value in values or []:
+        endpoint, seconds = value.split("=")
+        latencies[endpoint] = float(seconds)
+    return latencies
+
+def albert_stub(port: int = PORT):
+    if DEBUG: print("Starting Albert stub server...")
+    uvicorn.run(app, host="localhost", port=port)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the Albert API')
+    parser.add_argument('--port', type=int, default=PORT, help='Port to listen on')
+    parser.add_argument('--latency', action='append', help='Mean latency of an endpoint, e.g. chat=0.8 (repeatable)')
+    parser.add_argument('--jitter', type=float, default=0.2, help='Relative latency jitter')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Probability of injecting an error')
+    parser.add_argument('--error-status', type=int, default=503, help='Status code of injected errors')
+    parser.add_argument('--documents', type=int, default=20, help='Number of synthetic documents to seed')
+    args = parser.parse_args()
+
+    config = StubConfig(latencies=parse_latencies(args.latency), jitter=args.jitter, error_rate=args.error_rate, error_status=args.error_status)
+    seed(document_count=args.documents)
+    albert_stub(args.port)
+    exit(1)
@@ -3,7 +3,7 @@
 import os
 import dotenv
 dotenv.load_dotenv()
-BASE_URL = "https://albert.api.etalab.gouv.fr/v1"
+BASE_URL = os.getenv("ALBERT_BASE_URL", "https://albert.api.etalab.gouv.fr/v1")
 API_KEY = os.getenv("API_KEY")
 
 ###########################
@@ -17,8 +17,18 @@ MODEL_NAME = "albert_small"
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
-from openai import OpenAI
+try:
+    from .profiling import install_profiling
+    from .prompts import build_messages
+    from .albert_client import AlbertClient, install_error_handlers
+except ImportError:
+    from profiling import install_profiling
+    from prompts import build_messages
+    from albert_client import AlbertClient, install_error_handlers
 app = FastAPI()
+install_error_handlers(app)
+install_profiling(app)
+albert = AlbertClient(BASE_URL, API_KEY)
 
 origins = [
     "http://localhost",
@@ -35,13 +45,7 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-from datetime import datetime
 SYSTEM_PROMPT = True
-if (SYSTEM_PROMPT == True):
-    SYSTEM_PROMPT_FILE = "./src/system_prompt.txt"
-    with open(SYSTEM_PROMPT_FILE, "r") as file:
-        system_prompt = "".join(file.readlines()).format(currentDateTime=datetime.now().strftime("%Y-%m-%d"))
-        if DEBUG: print("system prompt", system_prompt) 
 
 ###########################
 # Class to extract prompt from body
@@ -58,16 +62,15 @@ class Body(BaseModel):
 
 @app.post("/")
 async def root(body: Body):
-    client = OpenAI(base_url=BASE_URL, api_key=API_KEY)
-    messages = [{"role": "user", "content": body.prompt}]
-    if SYSTEM_PROMPT: messages.append({"role": "system", "content": system_prompt})
+    messages, prefix_chars = build_messages(body.prompt, system=SYSTEM_PROMPT)
+    if DEBUG: print(f"Reusable prompt prefix: {prefix_chars} of {sum(len(m['content']) for m in messages)} chars.")
     data = {
         "model": MODEL_NAME,
         "messages": messages,
         "stream": False,
         "n": 1,
     }
-    response = client.chat.completions.create(**data)
+    response = await albert.chat_completion(**data)
     # if DEBUG: print(response.choices[0].message.content)
     return {"response": response.choices[0].message.content}
 
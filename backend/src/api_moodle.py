@@ -332,7 +332,7 @@ def download_all_files(
 import os
 import dotenv
 dotenv.load_dotenv()
-BASE_URL = "https://albert.api.etalab.gouv.fr/v1"
+BASE_URL = os.getenv("ALBERT_BASE_URL", "https://albert.api.etalab.gouv.fr/v1")
 API_KEY = os.getenv("API_KEY")
 
 ###########################
@@ -4,7 +4,7 @@ import os
 import dotenv
 import re
 dotenv.load_dotenv()
-BASE_URL = "https://albert.api.etalab.gouv.fr/v1"
+BASE_URL = os.getenv("ALBERT_BASE_URL", "https://albert.api.etalab.gouv.fr/v1")
 API_KEY = os.getenv("API_KEY")
 
 ###########################
@@ -13,19 +13,70 @@ DEBUG = True
 HISTORY_FILE_NAME = ".history.json"
 
 MOODLE_DIRECTORY = "moodle_storage/Moodle_files"
-COLLECTION_NAME = "moodle_pdfs"
+COLLECTION_NAME = "moodle_pdfs" # Prefix of the shard collections, named moodle_pdfs_0, moodle_pdfs_1, ...
+MAX_FILES_PER_SHARD = 20 # Max number of files uploaded to a single collection
+SHARD_SEARCH_TIMEOUT = 10 # Max number of seconds for the search in one shard, retries included
 MODEL_NAME = "albert-small"
+EMBEDDINGS_MODEL = "embeddings-small"
 MAX_HISTORY_CHARS = 3000 # Max of number of chars in the history and passed as context
 MAX_MESSAGES_HISTORY = 20 # Max number of messages kept in history and passed as context
 COMMAND_PREFIX = "/" # How to define a command in the chat
+BATCH_CONCURRENCY = 8 # Max number of questions of a batch answered at the same time
+CASSETTE_MODE = os.getenv("ALBERT_CASSETTE_MODE") # "record" or "replay" the Albert calls, see cassettes.py
+CASSETTE_DIR = os.getenv("ALBERT_CASSETTE_DIR", "cassettes")
+INGESTION = os.getenv("INGESTION", "0") == "1" # Watch MOODLE_DIRECTORY and ingest new files while serving
+CITATION_MAP_FILE = "moodle_storage/citation_map.json" # chunk id -> file, page and line, filled when files are uploaded
+CHUNKS_PAGE_SIZE = 100 # Number of chunks fetched per call when mapping an uploaded file
+
+HELP_MESSAGE = (
+    "Available commands:\n"
+    "/source <query> - Shows which Moodle files were used in the agent response.\n"
+    "/reset - Reset the chat history.\n"
+    "/find <extract> - Find which of your Moodle files are related to this extract. Also available by highlighting then \n"
+    "/help - Show this help message."
+)
 
 ###########################
 # Create a FastAPI instance
-from fastapi import FastAPI
+from fastapi import FastAPI, BackgroundTasks
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
 import uvicorn
-from openai import OpenAI
-app = FastAPI()
+try:
+    from .profiling import install_profiling
+    from .prompts import build_messages
+    from .albert_client import AlbertClient, UpstreamError, install_error_handlers
+    from .cassettes import CassetteAlbertClient
+except ImportError:
+    from profiling import install_profiling
+    from prompts import build_messages
+    from albert_client import AlbertClient, UpstreamError, install_error_handlers
+    from cassettes import CassetteAlbertClient
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run the ingestion pipeline alongside the server when INGESTION is set."""
+    if not INGESTION:
+        yield
+        return
+    try:
+        from .ingestion import IngestionPipeline
+    except ImportError:
+        from ingestion import IngestionPipeline
+    app.state.ingestion = IngestionPipeline()
+    await app.state.ingestion.start()
+    try:
+        yield
+    finally:
+        await app.state.ingestion.stop()
+
+app = FastAPI(lifespan=lifespan)
+install_error_handlers(app)
+install_profiling(app)
+if CASSETTE_MODE:
+    albert = CassetteAlbertClient(BASE_URL, API_KEY, CASSETTE_MODE, CASSETTE_DIR)
+else:
+    albert = AlbertClient(BASE_URL, API_KEY)
 
 origins = [
     "http://localhost",
@@ -41,12 +92,7 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-from datetime import datetime
 SYSTEM_PROMPT = True
-if (SYSTEM_PROMPT == True):
-    SYSTEM_PROMPT_FILE = "./src/system_prompt.txt"
-    with open(SYSTEM_PROMPT_FILE, "r") as file:
-        system_prompt = "".join(file.readlines()).format(currentDateTime=datetime.now().strftime("%Y-%m-%d"))
 
 ###########################
 # Class to extract prompt from body
@@ -55,85 +101,170 @@ class Body(BaseModel):
     prompt: str
     context: str
 
+class BodyBatch(BaseModel):
+    prompts: list[str]
+    context: str = ""
+
 ###########################
 # Other imports
-import requests
 import json
+import time
+import bisect
+import asyncio
+import threading
+import itertools
 from pypdf import PdfReader
 from tqdm import tqdm
 
+# Concurrent requests and background tasks write the history from several threads
+history_lock = threading.RLock()
+
 #######################################################################
 #######################################################################
 
 @app.post("/")
-async def root(body: Body):
-    global system_prompt
-
+async def root(body: Body, background_tasks: BackgroundTasks = None):
     prompt, command = parse_command(body.prompt)
+    answer, completion = await answer_prompt(prompt, command, body.context, history_reader=read_history)
+
+    # History ici, vu que l'apply command n'est pas un résultat du LLM
+    # Written once the response is sent, /reset clears it instead
+    if completion is not None and command != "reset":
+        if background_tasks is not None:
+            background_tasks.add_task(write_history, prompt, completion)
+        else:
+            await asyncio.to_thread(write_history, prompt, completion)
+
+    if DEBUG: print("Returning answer...")
+    return {"response": answer}
+
+@app.post("/batch")
+async def batch(body: BodyBatch):
+    """
+    Answer a list of prompts (commands included) without touching the chat history.
+    The collection is resolved once, up to BATCH_CONCURRENCY prompts are answered at
+    the same time, and PDF parsing and source location are shared by all prompts.
+    Results are streamed back as JSON lines, in the order they complete.
+    """
+    collection_ids = await get_collection_ids()
+    pdf_cache = PdfCache()
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def answer_item(index: int, prompt: str):
+        async with semaphore:
+            try:
+                answer = await answer_batch_prompt(prompt, body.context, collection_ids, pdf_cache)
+            except Exception as e:
+                if DEBUG: print(f"Batch prompt {index} failed: {e}")
+                return {"index": index, "prompt": prompt, "error": str(e)}
+        return {"index": index, "prompt": prompt, "response": answer}
+
+    async def stream():
+        tasks = [asyncio.create_task(answer_item(i, prompt)) for i, prompt in enumerate(body.prompts)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield json.dumps(await task) + "\n"
+        finally:
+            # The client went away, stop answering
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+async def answer_batch_prompt(prompt: str, context: str, collection_ids: list, pdf_cache: "PdfCache"):
+    """
+    Answer one prompt of a batch, like root but without history.
+    """
+    prompt, command = parse_command(prompt)
+    if command == "reset":
+        return "The 'reset' command is not available in batches."
+    answer, _ = await answer_prompt(prompt, command, context, collection_ids=collection_ids, pdf_cache=pdf_cache)
+    return answer
 
+async def answer_prompt(prompt: str, command: str, context: str, history_reader=None, collection_ids: list = None, pdf_cache: "PdfCache" = None):
+    """
+    Answer a parsed prompt, shared by root and /batch.
+    history_reader returns the chat history, it is called in a worker alongside the retrieval (no history if None).
+    Return the answer and the LLM completion, None when the LLM was not called.
+    """
     if command == "help":
         """Return a help message with available commands"""
-        help_message = (
-            "Available commands:\n"
-            "/source <query> - Shows which Moodle files were used in the agent response.\n"
-            "/reset - Reset the chat history.\n"
-            "/find <extract> - Find which of your Moodle files are related to this extract. Also available by highlighting then \n"
-            "/help - Show this help message."
-        )
-        return {"response": help_message}
+        return HELP_MESSAGE, None
 
-    collection_id = await get_collection_id()
-    # if (CHUNK_GOTTEN == False):
-    #     collection_id = await refresh_moodle_collection(collection_id)
-    #     CHUNK_GOTTEN = True
-    
-    # Get the top k chunks from the RAG service
+    # Retrieval (collection lookup then search) runs alongside the history read
     if DEBUG: print("Getting RAG chunks...")
-    chunks_dict_list = await get_rag_chunks(prompt, collection_id, k=5)
-    
-    # Source the chunks from the RAG service
-    chunk_file_sources = []
-    for chunk_dict in chunks_dict_list:
-        chunk_file_sources.append({
-            "file_name": chunk_dict["metadata"]["document_name"],
-            "chunk_id": chunk_dict["id"],
-            "content": chunk_dict["content"],
-        })
-
+    history = None
+    if command == "find" or history_reader is None:
+        chunks_dict_list, chunk_file_sources = await retrieve_chunks(prompt, collection_ids)
+    else:
+        (chunks_dict_list, chunk_file_sources), history = await asyncio.gather(
+            retrieve_chunks(prompt, collection_ids),
+            asyncio.to_thread(history_reader),
+        )
     if command == "find":
-        return {"response": "Sources related to the input text:\n" + "\n".join(sources_from_chunks(chunk_file_sources))}
+        sources = await asyncio.to_thread(sources_from_chunks, chunk_file_sources, pdf_cache)
+        return "Sources related to the input text:\n" + "\n".join(sources), None
+
+    # Locate the sources in the PDFs in a worker while the LLM generates
+    sources_task = None
+    if command == "source":
+        sources_task = asyncio.create_task(asyncio.to_thread(sources_from_chunks, chunk_file_sources, pdf_cache))
 
     # Get the full chunk
     full_chunk_rag = "\n\n\n".join([chunk_dict["content"] for chunk_dict in chunks_dict_list])
 
-    # Add explain prompt
-    if command == "explain":
-        system_prompt_explain = """\n\nYou are an expert in explaining concepts.\nYou will be given a text and you must explain it in simple terms, as if you were explaining it to a beginner in the field.\nYou must provide a clear and concise explanation.\nYou must not assume anything is true before detailing why it is true.\nYou must be sure to explain all the concepts in the text, even if they seem obvious.\nTake your time and explain little bit by little bit every part of the answer, especially when you introduce a new concept.\n\n"""
-
     # Call the OpenAI API with the full chunk and the prompt
     if DEBUG: print("Calling OpenAI API...")
-    client = OpenAI(base_url=BASE_URL, api_key=API_KEY)
-    messages = read_history()
-    if SYSTEM_PROMPT: messages.append({"role": "system", "content": system_prompt})
-    messages.append({"role": "context", "content": body.context})  # Add the context from the body
-    if command == "explain": messages.append({"role": "system", "content": system_prompt_explain})
-    messages.append({"role": "tool", "content": full_chunk_rag})
-    messages.append({"role": "user", "content": prompt})
+    messages, prefix_chars = build_messages(
+        prompt,
+        history=history,
+        context=context,
+        chunks=full_chunk_rag,
+        explain=command == "explain",
+        system=SYSTEM_PROMPT,
+    )
+    if DEBUG: print(f"Reusable prompt prefix: {prefix_chars} of {sum(len(m['content']) for m in messages)} chars.")
     data = {
         "model": MODEL_NAME,
         "messages": messages,
         "stream": False,
         "n": 1,
     }
-    response = client.chat.completions.create(**data)
+    try:
+        response = await albert.chat_completion(**data)
+    except BaseException:
+        if sources_task is not None: sources_task.cancel()
+        raise
+    sources = await sources_task if sources_task is not None else None
+
+    completion = response.choices[0].message.content
+    if DEBUG: print("Applying special command if any...")
+    return apply_command(completion, command, chunk_file_sources, sources), completion
 
-    # History ici, vu que l'apply command n'est pas un résultat du LLM
-    write_history(prompt, response.choices[0].message.content)    
+async def retrieve_chunks(prompt: str, collection_ids: list = None, k: int = 5, cosine_similarity_minimum: float = 0.5):
+    """
+    Get the top k chunks for the prompt and where they come from.
+    """
+    if collection_ids is None:
+        collection_ids = await get_collection_ids()
+    # if (CHUNK_GOTTEN == False):
+    #     collection_ids = await refresh_moodle_collection(collection_ids)
+    #     CHUNK_GOTTEN = True
 
-    if DEBUG: print("Applying special command if any...")
-    answer = apply_command(response.choices[0].message.content, command, chunk_file_sources)
-    if DEBUG: print("Returning answer...")
-    return {"response": answer}
+    # Get the top k chunks from the RAG service
+    chunks_dict_list = await get_rag_chunks(prompt, collection_ids, k=k, cosine_similarity_minimum=cosine_similarity_minimum)
+
+    # Source the chunks from the RAG service
+    chunk_file_sources = []
+    for chunk_dict in chunks_dict_list:
+        chunk_file_sources.append({
+            "file_name": chunk_dict["metadata"]["document_name"],
+            "document_id": chunk_dict["metadata"]["document_id"],
+            "chunk_id": chunk_dict["id"],
+            "content": chunk_dict["content"],
+        })
+
+    return chunks_dict_list, chunk_file_sources
 
 def DEBUG_write_file_from_string(file_name: str, content: str, utf_8 : bool = False):
     """
@@ -147,26 +278,37 @@ def DEBUG_write_file_from_string(file_name: str, content: str, utf_8 : bool = Fa
             f.write(content)
     print(f"Written content to {file_name} for debugging purposes.")
 
-def read_pdf(file_name: str):
+def read_pdf(file_name: str, directory: str = None):
+    return "".join(page + "\n" for page in read_pdf_pages(file_name, directory))
+
+def read_pdf_pages(file_name: str, directory: str = None):
     # Take current directory, go back up one level, and then go to moodle_pdfs directory
-    reader = PdfReader(os.path.join(MOODLE_DIRECTORY, file_name))
-    if DEBUG: print(f"Reading PDF file: {os.path.join(MOODLE_DIRECTORY, file_name)}")
-    text = ""
-    for page in reader.pages:
-        text += page.extract_text() + "\n"
+    directory = directory or MOODLE_DIRECTORY
+    reader = PdfReader(os.path.join(directory, file_name))
+    if DEBUG: print(f"Reading PDF file: {os.path.join(directory, file_name)}")
+    pages = [page.extract_text() for page in reader.pages]
     if DEBUG: print(f"Read {len(reader.pages)} pages from PDF file.")
-    return text
+    return pages
+
+def save_json_atomically(path: str, obj):
+    """Write then rename, so a crash never leaves a truncated file."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporary_file = path + ".tmp"
+    with open(temporary_file, "w") as f:
+        json.dump(obj, f)
+    os.replace(temporary_file, path)
 
 def read_history():
     """
     Read the history from the history.json file.
     """
     history_file = HISTORY_FILE_NAME
-    if not os.path.exists(history_file):
-        return []
-    
-    with open(history_file, "r") as f:
-        history = json.load(f)
+    with history_lock:
+        if not os.path.exists(history_file):
+            return []
+
+        with open(history_file, "r") as f:
+            history = json.load(f)
     
     return history
 
@@ -175,8 +317,18 @@ def write_history(prompt: str, response: str):
     Write the prompt and response to the history.json file.
     """
     history_file = HISTORY_FILE_NAME
-    history = read_history()
-    
+    with history_lock:
+        history = read_history()
+        history = append_history(history, prompt, response)
+
+        # Write the updated history back to the file
+        with open(history_file, "w") as f:
+            json.dump(history, f)
+
+def append_history(history: list, prompt: str, response: str):
+    """
+    Append the prompt and response to the history, trimmed to MAX_HISTORY_CHARS and MAX_MESSAGES_HISTORY.
+    """
     # Append the new entry
     history.append({"role": "user", "content": prompt})
     history.append({"role": "assistant", "content": response})
@@ -190,73 +342,216 @@ def write_history(prompt: str, response: str):
         total_chars -= len(history[0]["content"]) + len(history[1]["content"])
         history = history[2:]  # Remove the first user and assistant entries
 
-    # Write the updated history back to the file
-    with open(history_file, "w") as f:
-        json.dump(history, f)
+    return history
 
 
-def pdf_lines_from_chunks(chunk_file_sources: list):
-    # Read the PDF file
-    pdf_content = dict()
-    pdf_newline_count = dict()
-    pdf_content_alpha = dict()
-    pdf_alpha_indices = dict()
-    for chunk_file_source in chunk_file_sources:
-        file_name = chunk_file_source["file_name"]
-        if file_name not in pdf_content.keys():
-            pdf_content[file_name] = read_pdf(file_name)
-            pdf_newline_count[file_name] = pdf_content[file_name].count("\n")
-            pdf_content_alpha[file_name] = "".join([i for i in pdf_content[file_name] if i.isalpha()])
-            pdf_alpha_indices[file_name] = [i for i in range(len(pdf_content_alpha[file_name])) if pdf_content_alpha[file_name][i].isalpha()]
-    
+class PdfCache:
+    """
+    Parsed PDF files and located chunk lines, shared by the items of a batch.
+    Safe to use from several worker threads, each file is parsed only once.
+    """
+    def __init__(self):
+        self.pdfs = dict() # file name -> (content, alpha content, alpha indices)
+        self.lines = dict() # (document id, chunk id) -> line number, or None if not found
+        self._lock = threading.Lock()
+        self._file_locks = dict()
+
+    def get(self, file_name: str):
+        with self._lock:
+            file_lock = self._file_locks.setdefault(file_name, threading.Lock())
+        with file_lock:
+            if file_name not in self.pdfs:
+                self.pdfs[file_name] = alpha_content(read_pdf(file_name))
+        return self.pdfs[file_name]
+
+def alpha_content(pdf_content: str):
+    """The PDF content, its letters only (for naive chunk search) and their indices."""
+    pdf_content_alpha = "".join([i for i in pdf_content if i.isalpha()])
+    pdf_alpha_indices = [i for i in range(len(pdf_content)) if pdf_content[i].isalpha()]
+    return pdf_content, pdf_content_alpha, pdf_alpha_indices
+
+def line_number(text: str):
+    """Number of lines before the end of the text (the first line is 0), blank lines are not counted."""
+    return text.count("\n") - text.count("\n\n")
+
+def locate_chunk(chunk: str, pdf_content: str, pdf_content_alpha: str, pdf_alpha_indices: list):
+    """
+    Find the chunk in the PDF content.
+    Return the position of the match in the PDF content and its line number, or (None, None).
+    """
+    chunk = "".join([i for i in chunk if i.isalpha()])  # Remove non-alpha characters for naive search
+
+    # Find the chunk in the PDF content with re string matching
+    regex_pattern = re.escape(chunk[:min(70, len(chunk))])  # Use a bit of the chunk for regex matching
+    match = re.search(regex_pattern, pdf_content_alpha)
+    if not match:
+        return None, None
+
+    # If a match is found, calculate the line number based on the number of newlines before the match
+    start_index = pdf_alpha_indices[match.start()]
+    return start_index, line_number(pdf_content[:start_index])
+
+def chunk_key(chunk_file_source: dict):
+    """Chunk ids are only unique within a document."""
+    return chunk_file_source["document_id"], chunk_file_source["chunk_id"]
+
+def pdf_lines_from_chunks(chunk_file_sources: list, pdf_cache: PdfCache = None):
+    if pdf_cache is None:
+        pdf_cache = PdfCache()
+
     # initialize the line number dictionary
     line_numbers = dict()
     
     if DEBUG: print("Searching for chunks in PDF content...")
 
     for chunk_file_source in chunk_file_sources:
-        chunk = chunk_file_source["content"]
-        chunk = "".join([i for i in chunk if i.isalpha()])  # Remove non-alpha characters for naive search
-
-        line = None
-
-        chunk_filename = chunk_file_source["file_name"]
-        # Find the chunk in the PDF content with re string matching
-        regex_pattern = re.escape(chunk[:min(70, len(chunk))])  # Use a bit of the chunk for regex matching
-        match = re.search(regex_pattern, pdf_content_alpha[chunk_filename])
-        if match:
-            # If a match is found, calculate the line number
-            start_index = match.start()
-            # Calculate the line number based on the number of newlines before the match
-            #line = pdf_content[chunk_filename][:start_index].count("\n") - pdf_content[chunk_filename][:start_index].count("\n\n") + 1
-            line = pdf_content[chunk_filename][:pdf_alpha_indices[chunk_filename][start_index]].count("\n") - pdf_content[chunk_filename][:pdf_alpha_indices[chunk_filename][start_index]].count("\n\n")
-        
-        line_numbers[chunk_file_source["chunk_id"]] = line
+        if chunk_key(chunk_file_source) in pdf_cache.lines:
+            line_numbers[chunk_key(chunk_file_source)] = pdf_cache.lines[chunk_key(chunk_file_source)]
+            continue
+
+        # Read the PDF file and find the chunk in it
+        _, line = locate_chunk(chunk_file_source["content"], *pdf_cache.get(chunk_file_source["file_name"]))
+
+        line_numbers[chunk_key(chunk_file_source)] = line
+        pdf_cache.lines[chunk_key(chunk_file_source)] = line
     
     if DEBUG: print("Finished searching for chunks in PDF content.")
 
     return line_numbers
 
-def sources_from_chunks(chunk_file_sources: list):
+def sources_from_chunks(chunk_file_sources: list, pdf_cache: PdfCache = None):
+    # Chunks mapped at upload time are looked up, only the others are searched in their PDF
+    citations = dict()
+    for chunk_file_source in chunk_file_sources:
+        citation = citation_map.get(*chunk_key(chunk_file_source))
+        if citation is not None and citation["file_name"] != chunk_file_source["file_name"]:
+            citation = None # Mapped for another file, do not trust it
+        citations[chunk_key(chunk_file_source)] = citation
+    unmapped = [chunk_file_source for chunk_file_source in chunk_file_sources if citations[chunk_key(chunk_file_source)] is None]
+    if unmapped:
+        line_sources = pdf_lines_from_chunks(unmapped, pdf_cache)
+        for chunk_file_source in unmapped:
+            citations[chunk_key(chunk_file_source)] = {"page": None, "line": line_sources[chunk_key(chunk_file_source)]}
+
     sources = []
-    line_sources = pdf_lines_from_chunks(chunk_file_sources)
-    for i, chunk_file_source in enumerate(chunk_file_sources):
-        if line_sources[chunk_file_source['chunk_id']] is not None:
-            sources.append(f"File: {chunk_file_source['file_name']}, around line {line_sources[chunk_file_source['chunk_id']]}.")
-        else:
+    for chunk_file_source in chunk_file_sources:
+        citation = citations[chunk_key(chunk_file_source)]
+        if citation["line"] is None:
             sources.append(f"File: {chunk_file_source['file_name']}, line not found (common in LaTeX pdfs).")
+        elif citation["page"] is not None:
+            sources.append(f"File: {chunk_file_source['file_name']}, page {citation['page']}, around line {citation['line']}.")
+        else:
+            sources.append(f"File: {chunk_file_source['file_name']}, around line {citation['line']}.")
     return sources
 
-def apply_command(response: str, command: str, chunk_file_sources: list):
+
+class CitationMap:
+    """
+    Where each uploaded chunk is in its PDF, as (document id, chunk id) -> {"file_name", "document_id", "page", "line"},
+    the line being counted from the top of the page. Chunk ids are only unique within a document
+    and do not change once a file is uploaded, so the map is filled at upload time and saved to
+    CITATION_MAP_FILE. Read from worker threads, written from the event loop.
+    """
+    VERSION = 2 # Maps saved with another version are dropped, their chunks are searched at query time
+
+    def __init__(self, path: str = CITATION_MAP_FILE):
+        self.path = path
+        self.chunks = self._load()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(document_id, chunk_id):
+        return f"{document_id}/{chunk_id}"
+
+    def get(self, document_id, chunk_id):
+        with self._lock:
+            return self.chunks.get(self._key(document_id, chunk_id))
+
+    def update(self, citations: dict):
+        with self._lock:
+            self.chunks.update({self._key(*key): citation for key, citation in citations.items()})
+            self._save()
+
+    def remove_document(self, document_id):
+        with self._lock:
+            self.chunks = {chunk_id: citation for chunk_id, citation in self.chunks.items() if citation["document_id"] != document_id}
+            self._save()
+
+    def clear(self):
+        with self._lock:
+            self.chunks = dict()
+            self._save()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return dict()
+        with open(self.path, "r") as f:
+            saved = json.load(f)
+        if saved.get("version") != self.VERSION:
+            return dict()
+        return saved["chunks"]
+
+    def _save(self):
+        save_json_atomically(self.path, {"version": self.VERSION, "chunks": self.chunks})
+
+citation_map = CitationMap()
+
+async def index_citations(document_id, file_name: str, directory: str = None, pages: list = None):
+    """
+    Fetch the chunks of an uploaded file once and store where each one is in the PDF.
+    Best effort: chunks that are not mapped are searched at query time by sources_from_chunks.
+    """
+    try:
+        chunks = []
+        offset = 0
+        while offset == 0 or len(data) == CHUNKS_PAGE_SIZE:
+            response = await albert.request("chunks", "GET", f"/chunks/{document_id}?offset={offset}&limit={CHUNKS_PAGE_SIZE}", idempotent=True)
+            data = response.json()["data"]
+            chunks.extend(data)
+            offset += CHUNKS_PAGE_SIZE
+
+        citations = await asyncio.to_thread(locate_chunks_in_pages, chunks, file_name, document_id, directory, pages)
+        await asyncio.to_thread(citation_map.update, citations)
+    except Exception as e:
+        print(f"Could not map the chunks of {file_name}: {e}")
+        return dict()
+
+    if DEBUG: print(f"Mapped {sum(citation['line'] is not None for citation in citations.values())} of {len(chunks)} chunks of {file_name}.")
+    return citations
+
+def locate_chunks_in_pages(chunks: list, file_name: str, document_id, directory: str = None, pages: list = None):
+    """
+    Locate the chunks in the PDF, in one pass over the file.
+    Chunks that are not found are kept with no page and line, so they are not searched again.
+    """
+    if pages is None:
+        pages = read_pdf_pages(file_name, directory)
+    pdf = alpha_content("".join(page + "\n" for page in pages))
+    # Position of each page in the content, to turn the position of a match into a page and a line in it
+    page_starts = list(itertools.accumulate([len(page) + 1 for page in pages[:-1]], initial=0))
+
+    citations = dict()
+    for chunk in chunks:
+        page, line = None, None
+        start_index, _ = locate_chunk(chunk["content"], *pdf)
+        if start_index is not None:
+            page = bisect.bisect_right(page_starts, start_index)
+            line = line_number(pdf[0][page_starts[page - 1]:start_index])
+        citations[(document_id, chunk["id"])] = {"file_name": file_name, "document_id": document_id, "page": page, "line": line}
+    return citations
+
+def apply_command(response: str, command: str, chunk_file_sources: list, sources: list = None):
     if command is None or command == "explain":
         return response
     elif command == "source":
         # If the command is "source", we return the sources of the chunks
-        sources = sources_from_chunks(chunk_file_sources)
+        if sources is None:
+            sources = sources_from_chunks(chunk_file_sources)
         return response + "\n\nSources used :\n" + "\n".join(sources)
     elif (command == "reset"):
-        with open(HISTORY_FILE_NAME, "w") as f:
-            json.dump([], f)
+        with history_lock:
+            with open(HISTORY_FILE_NAME, "w") as f:
+                json.dump([], f)
         return "History reset."
     elif (command == "find" or command == "help"):
         raise Exception(f"The '{command}' command should be handled separately.")
@@ -276,82 +571,153 @@ def parse_command(prompt: str):
     
     return prompt, command
 
-async def get_collection_id():
-    # Get if the collection already exists
-    collection_id = None
+async def get_collection_ids():
+    """
+    Get the ids of all the shards of the Moodle collection, ordered by shard index.
+    A legacy single collection named COLLECTION_NAME is kept as shard -1, searched and refreshed like the others.
+    """
+    shards = await get_collection_shards()
+    return [shards[shard_index]["id"] for shard_index in sorted(shards)]
+
+async def get_collection_shards():
+    """
+    Get the collections that are shards of the Moodle collection, as a dict shard index -> collection.
+    """
+    shards = dict()
     offset = 0
     while offset == 0 or len(response["data"]) == 100:
-        # Connect to the session
-        session = requests.session()
-        session.headers = {"Authorization": f"Bearer {API_KEY}"}
-
         # Get the list of collections
-        response = session.get(f"{BASE_URL}/collections?offset={offset}&limit=100")
+        response = await albert.request("collections", "GET", f"/collections?offset={offset}&limit=100")
         offset += 100
-        assert response.status_code == 200
         response = response.json()
  
-        # Check if the collection already exists
+        # Keep the collections that are shards of the Moodle collection
         for collection in response["data"]:
-            if collection["name"] == COLLECTION_NAME:
-                collection_id = collection["id"]
-                break
+            shard_index = parse_shard_name(collection["name"])
+            if shard_index is not None:
+                if shard_index in shards:
+                    print(f"Several collections are named {collection['name']}, only collection {collection['id']} is used, delete the others.")
+                shards[shard_index] = collection
 
         if offset > 1000:
             raise Exception("Too many collections for Albert API please delete some before refreshing the moodle collection.")
         
-    return collection_id
+    return shards
 
-async def refresh_moodle_collection(collection_id: int):
-    # Upload a collection of PDF files to the RAG service
-    session = requests.session()
-    session.headers = {"Authorization": f"Bearer {API_KEY}"}
+def shard_name(shard_index: int):
+    return f"{COLLECTION_NAME}_{shard_index}"
 
-    EMBEDDINGS_MODEL = "embeddings-small"
-
-    if collection_id is not None:
-        # If the collection exists, we first delete it to refresh it
-        response = session.delete(f"{BASE_URL}/collections/{collection_id}")
-        assert response.status_code == 204
-
-    # Create a collection for RAG
-    response = session.post(f"{BASE_URL}/collections", json={"name": COLLECTION_NAME, "model": EMBEDDINGS_MODEL})
-    assert response.status_code == 201
-    response = response.json()
-    collection_id = response["id"]
-    
-    # Get all pdf files in ./moodle_pdfs/
-    pdf_files = [f for f in os.listdir(MOODLE_DIRECTORY) if f.endswith(".pdf")]
-
-    # Add all pdf files to the collection
-    for file_local_path in pdf_files[:20]: # TODO remove limitations and do multiple collections
-        # If file more than 20 MB, skip it
-        file_path = os.path.join(MOODLE_DIRECTORY, file_local_path)
-        if os.path.getsize(file_path) > 20000000:
-            continue
-        files = {"file": (os.path.basename(file_path), open(file_path, "rb"), "application/pdf")}
-        data = {"request": '{"collection": "%s"}' % collection_id}
-        response = session.post(f"{BASE_URL}/files", data=data, files=files)
-        if response.status_code != 201:
-            print(f"Error uploading file {file_local_path}: {response.status_code} - {response.text}")
-            continue
+def parse_shard_name(name: str):
+    """
+    Return the shard index of a collection name, or None if it is not a shard of the Moodle collection.
+    """
+    if name == COLLECTION_NAME:
+        return -1
+    prefix = COLLECTION_NAME + "_"
+    if name.startswith(prefix) and name[len(prefix):].isdigit():
+        return int(name[len(prefix):])
+    return None
+
+def shard_files(file_paths: list):
+    """
+    Distribute the files over as few shards as MAX_FILES_PER_SHARD allows,
+    balancing the total size of each shard (largest files placed first).
+    """
+    shard_count = max(1, -(-len(file_paths) // MAX_FILES_PER_SHARD))
+    shards = [[] for _ in range(shard_count)]
+    shard_sizes = [0] * shard_count
+    for file_path in sorted(file_paths, key=os.path.getsize, reverse=True):
+        open_shards = [i for i in range(shard_count) if len(shards[i]) < MAX_FILES_PER_SHARD]
+        shard_index = min(open_shards, key=lambda i: shard_sizes[i])
+        shards[shard_index].append(file_path)
+        shard_sizes[shard_index] += os.path.getsize(file_path)
+    return shards
+
+async def refresh_moodle_collection(collection_ids: list):
+    try:
+        from .ingestion import shared_state, describe_file
+    except ImportError:
+        from ingestion import shared_state, describe_file
 
-    return collection_id
+    # Upload a collection of PDF files to the RAG service
+    # If the shards exist, we first delete them to refresh them
+    for collection_id in collection_ids:
+        await albert.request("collections", "DELETE", f"/collections/{collection_id}", expected_status=(204,))
+    await asyncio.to_thread(citation_map.clear)
+    # The ingestion state is rebuilt with the new uploads, so the pipeline does not upload them again
+    ingestion_state = shared_state()
+    ingestion_state.clear()
+
+    # Get all pdf files in ./moodle_pdfs/, if file more than 20 MB, skip it
+    pdf_files = [os.path.join(MOODLE_DIRECTORY, f) for f in os.listdir(MOODLE_DIRECTORY) if f.endswith(".pdf")]
+    pdf_files = [file_path for file_path in pdf_files if os.path.getsize(file_path) <= 20000000]
+
+    async def upload_shard(shard_index: int, file_paths: list):
+        # Create a collection for this shard
+        response = await albert.request("collections", "POST", "/collections", expected_status=(201,), json={"name": shard_name(shard_index), "model": EMBEDDINGS_MODEL})
+        collection_id = response.json()["id"]
+
+        # Add the pdf files of the shard to its collection
+        # Each file is mapped for /source while the next one uploads
+        citation_tasks = []
+        for file_path in file_paths:
+            data = {"request": '{"collection": "%s"}' % collection_id}
+            entry = await asyncio.to_thread(describe_file, file_path)
+            with open(file_path, "rb") as f:
+                files = {"file": (os.path.basename(file_path), f, "application/pdf")}
+                try:
+                    response = await albert.request("files", "POST", "/files", expected_status=(201,), data=data, files=files)
+                except UpstreamError as e:
+                    print(f"Error uploading file {os.path.basename(file_path)}: {e}")
+                    continue
+            ingestion_state[os.path.basename(file_path)] = dict(entry, collection_id=collection_id, document_id=response.json()["id"], indexed_at=time.time())
+            citation_tasks.append(asyncio.create_task(index_citations(response.json()["id"], os.path.basename(file_path))))
+        await asyncio.gather(*citation_tasks)
+        return collection_id
+
+    # Shards are uploaded concurrently, the "files" endpoint limit keeps the upstream load bounded
+    shards = shard_files(pdf_files)
+    if DEBUG: print(f"Uploading {len(pdf_files)} PDF files in {len(shards)} shards...")
+    collection_ids = list(await asyncio.gather(*[upload_shard(i, file_paths) for i, file_paths in enumerate(shards)]))
+    await asyncio.to_thread(ingestion_state.save)
+    return collection_ids
+
+
+async def get_rag_chunks(prompt: str, collection_ids: list, k: int = 5, cosine_similarity_minimum: float = 0.5):
+    """
+    Search every shard concurrently and merge the results into a global top k by score.
+    Shards that fail or exceed SHARD_SEARCH_TIMEOUT are left out of the results.
+    """
+    async def search_shard(collection_id: int):
+        # Searching is read-only so it is safe to retry, attempts are cut to fit in the shard deadline
+        # and wait_for bounds responses trickling in slower than the socket read timeout
+        data = {"collections": [collection_id], "k": k, "prompt": prompt, "method": "semantic"}
+        response = await asyncio.wait_for(
+            albert.request("search", "POST", "/search", idempotent=True, deadline=SHARD_SEARCH_TIMEOUT, json=data),
+            SHARD_SEARCH_TIMEOUT,
+        )
+        return response.json()["data"]
 
+    shard_results = await asyncio.gather(*[search_shard(collection_id) for collection_id in collection_ids], return_exceptions=True)
 
-async def get_rag_chunks(prompt: str, collection_id : int, k: int = 5, cosine_similarity_minimum: float = 0.5):
-    # Connect to the session
-    session = requests.session()
-    session.headers = {"Authorization": f"Bearer {API_KEY}"}
+    results = []
+    errors = []
+    for collection_id, shard_result in zip(collection_ids, shard_results):
+        if isinstance(shard_result, BaseException):
+            if DEBUG: print(f"Search in collection {collection_id} failed: {type(shard_result).__name__}: {shard_result}")
+            errors.append(shard_result)
+        else:
+            results.extend(shard_result)
 
-    # Get the top k chunks from the RAG service
-    data = {"collections": [collection_id], "k": k, "prompt": prompt, "method": "semantic"}
-    response = session.post(url=f"{BASE_URL}/search", json=data)
+    # Only fail when no shard answered
+    if errors and len(errors) == len(collection_ids):
+        raise errors[0]
 
     #chunks_dicts_list = [result["chunk"] for result in response.json()["data"]]
-    
+
+    results.sort(key=lambda result_chunk: result_chunk["score"], reverse=True)
     thresholded_chunks_dicts_list = []
-    for result_chunk in response.json().get("data", ""):
+    for result_chunk in results[:k]:
         if result_chunk["score"] >= cosine_similarity_minimum:
             thresholded_chunks_dicts_list.append(result_chunk["chunk"])
 
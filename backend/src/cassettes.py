@@ -0,0 +1,168 @@
+"""
+Record/replay of the Albert calls made by api_rag.
+
+In "record" mode, every call goes to the Albert API and its response and latency
+are stored on disk as a cassette (one JSON file per call). In "replay" mode, calls
+are answered from the cassettes without touching the network, optionally waiting
+the recorded latency.
+
+Matching rules:
+-  /search ignores "k": a search recorded with a large k answers any smaller k,
+   since semantic top k results are a prefix of the top K results.
+-  /chat/completions falls back to the model and last user message when no call
+   with the exact same messages was recorded, so completions can be replayed under
+   different retrieval and history settings.
+Any other call must match exactly (method, path and body).
+
+Enable it in api_rag with ALBERT_CASSETTE_MODE=record|replay and ALBERT_CASSETTE_DIR.
+"""
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+
+from openai.types.chat import ChatCompletion
+
+try:
+    from .albert_client import AlbertClient, UpstreamError
+except ImportError:
+    from albert_client import AlbertClient, UpstreamError
+
+###########################
+# ENV CONSTS
+DEBUG = True
+CASSETTE_DIR = "cassettes"
+
+
+class CassetteMissError(UpstreamError):
+    """No recorded call matches the call being replayed."""
+
+
+class ReplayedResponse:
+    """The subset of requests.Response used by the apps."""
+    def __init__(self, status_code: int, body):
+        self.status_code = status_code
+        self.text = body if isinstance(body, str) else json.dumps(body)
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class CassetteAlbertClient(AlbertClient):
+    def __init__(self, base_url: str, api_key: str, mode: str, directory: str = CASSETTE_DIR, latency_scale: float = 0.0, policies: dict = None):
+        super().__init__(base_url, api_key, policies)
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode '{mode}', expected 'record' or 'replay'.")
+        self.mode = mode
+        self.directory = directory
+        self.latency_scale = latency_scale # Fraction of the recorded latency waited when replaying
+        self.upstream_time = 0.0 # Recorded latency of all the calls replayed or recorded so far
+        self.loose_replays = 0 # Calls replayed from a loose match, their latency was recorded for another request
+        self.cassettes = dict() # key -> cassette
+        self.loose_cassettes = dict() # loose key -> cassette
+        self._load()
+
+    ###########################
+    # Keys
+    @staticmethod
+    def _key(*parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+    def _request_key(self, method: str, path: str, kwargs: dict):
+        body = kwargs.get("json")
+        if path == "/search" and body is not None:
+            body = {key: value for key, value in body.items() if key != "k"}
+        if "files" in kwargs:
+            # Uploads are matched by file name and form data, not by content
+            body = {"data": kwargs.get("data"), "files": {name: value[0] for name, value in kwargs["files"].items()}}
+        return self._key(method.upper(), path, body)
+
+    def _chat_keys(self, data: dict):
+        user_messages = [message["content"] for message in data.get("messages", []) if message["role"] == "user"]
+        loose_key = self._key("chat", data.get("model"), user_messages[-1] if user_messages else None)
+        return self._key("chat", data), loose_key
+
+    ###########################
+    # Storage
+    def _load(self):
+        if not os.path.isdir(self.directory):
+            return
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith(".json"):
+                with open(os.path.join(self.directory, file_name), "r", encoding="utf-8") as f:
+                    self._index(json.load(f))
+        if DEBUG: print(f"Loaded {len(self.cassettes)} cassettes from {self.directory}.")
+
+    def _index(self, cassette: dict):
+        self.cassettes[cassette["key"]] = cassette
+        if cassette.get("loose_key") is not None:
+            self.loose_cassettes[cassette["loose_key"]] = cassette
+
+    def _save(self, cassette: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, cassette["key"] + ".json"), "w", encoding="utf-8") as f:
+            json.dump(cassette, f, ensure_ascii=False, indent=1)
+        self._index(cassette)
+
+    async def _replay(self, endpoint: str, key: str, loose_key: str = None):
+        cassette = self.cassettes.get(key)
+        if cassette is None and loose_key is not None:
+            cassette = self.loose_cassettes.get(loose_key)
+            if cassette is not None:
+                self.loose_replays += 1
+        if cassette is None:
+            raise CassetteMissError(endpoint, "no recorded call matches this call")
+        self.upstream_time += cassette["elapsed"]
+        if self.latency_scale > 0:
+            await asyncio.sleep(cassette["elapsed"] * self.latency_scale)
+        return cassette
+
+    ###########################
+    # Calls
+    async def request(self, endpoint: str, method: str, path: str, expected_status=(200,), idempotent: bool = None, **kwargs):
+        key = self._request_key(method, path, kwargs)
+
+        if self.mode == "replay":
+            cassette = await self._replay(endpoint, key)
+            body = cassette["response"]
+            k = (kwargs.get("json") or {}).get("k")
+            if path == "/search" and k is not None and isinstance(body, dict):
+                if DEBUG and k > (cassette.get("k") or 0): print(f"Search replayed with k={k} was recorded with k={cassette.get('k')}.")
+                body = dict(body, data=body["data"][:k])
+            return ReplayedResponse(cassette["status_code"], body)
+
+        start = time.monotonic()
+        response = await super().request(endpoint, method, path, expected_status, idempotent, **kwargs)
+        elapsed = time.monotonic() - start
+        self.upstream_time += elapsed
+        try:
+            body = response.json()
+        except ValueError:
+            body = response.text
+
+        # Keep the search recorded with the largest k, it answers every smaller k
+        k = (kwargs.get("json") or {}).get("k")
+        recorded = self.cassettes.get(key)
+        if path == "/search" and recorded is not None and (recorded.get("k") or 0) > (k or 0):
+            return response
+
+        self._save({"key": key, "endpoint": endpoint, "method": method.upper(), "path": path, "k": k,
+                    "request": kwargs.get("json"), "status_code": response.status_code, "response": body, "elapsed": elapsed})
+        return response
+
+    async def chat_completion(self, **data):
+        key, loose_key = self._chat_keys(data)
+
+        if self.mode == "replay":
+            cassette = await self._replay("chat", key, loose_key)
+            return ChatCompletion.model_validate(cassette["response"])
+
+        start = time.monotonic()
+        response = await super().chat_completion(**data)
+        elapsed = time.monotonic() - start
+        self.upstream_time += elapsed
+        self._save({"key": key, "loose_key": loose_key, "endpoint": "chat", "method": "POST", "path": "/chat/completions",
+                    "request": data, "status_code": 200, "response": response.model_dump(), "elapsed": elapsed})
+        return response
@@ -0,0 +1,44 @@
+# shared fixtures for the test files
+
+import os
+import copy
+import socket
+import tempfile
+import pytest
+import api_rag
+import albert_stub
+import load_test
+from albert_client import AlbertClient
+
+@pytest.fixture
+def albert_stub_url():
+  """
+  Serve albert_stub with no latency on a free port and return its base URL.
+  The stub config and state are restored afterwards, the environment is left untouched.
+  """
+  saved = albert_stub.config, copy.deepcopy(albert_stub.collections), copy.deepcopy(albert_stub.documents), dict(albert_stub.next_ids)
+  albert_stub.config = albert_stub.StubConfig(latencies={}, jitter=0.0)
+  with socket.socket() as s:
+    s.bind(("localhost", 0))
+    port = s.getsockname()[1]
+  server, thread = load_test.serve(albert_stub.app, port)
+  try:
+    yield f"http://localhost:{port}/v1"
+  finally:
+    server.should_exit = True
+    thread.join()
+    albert_stub.config = saved[0]
+    for state, saved_state in zip((albert_stub.collections, albert_stub.documents, albert_stub.next_ids), saved[1:]):
+      state.clear()
+      state.update(saved_state)
+
+@pytest.fixture
+def stub_rag(albert_stub_url, monkeypatch):
+  """
+  Point api_rag at albert_stub with an empty citation map in a temporary directory, quietly.
+  Return the stub base URL.
+  """
+  monkeypatch.setattr(api_rag, "albert", AlbertClient(albert_stub_url, "stub"))
+  monkeypatch.setattr(api_rag, "citation_map", api_rag.CitationMap(os.path.join(tempfile.mkdtemp(), "citation_map.json")))
+  monkeypatch.setattr(api_rag, "DEBUG", False)
+  return albert_stub_url
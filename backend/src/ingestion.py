@@ -0,0 +1,400 @@
+"""
+Continuous ingestion of MOODLE_DIRECTORY into the sharded Moodle collection.
+
+New or changed PDF files are picked up by a watcher (inotify on Linux, polling
+elsewhere or when inotify is unavailable), debounced so that a burst of writes from
+flatten_directory yields a single event per file, then pushed through staged workers:
+
+    watcher -> debounce -> hash -> extract text -> upload -> index (and map chunks for /source)
+
+Stages are connected by bounded queues, so a slow upload backs the earlier stages up
+instead of piling files in memory. Files whose content did not change since the last
+run (same sha256) are skipped, changed files replace their previous document.
+The state is shared with api_rag.refresh_moodle_collection, so files it uploaded are
+not uploaded again.
+
+Without a state file (first start on a collection built by an older version), the state
+is rebuilt from the documents already in the shards, matched to the files by name, and
+their local content is assumed to be the uploaded one: a file changed before this first
+start is only uploaded again on its next change, run refresh_moodle_collection to
+rebuild everything instead. If the shards cannot be listed, the startup catch-up is
+skipped rather than uploading every file a second time. A file is only in the pipeline once at a time, a change seen
+while its previous version is still uploading is picked up once that one is indexed.
+
+Run standalone from the backend directory with:
+    python src/ingestion.py
+or set INGESTION=1 to run it inside the api_rag server.
+"""
+
+import os
+import sys
+import json
+import time
+import struct
+import asyncio
+import hashlib
+import ctypes
+import ctypes.util
+
+try:
+    from . import api_rag
+    from .albert_client import UpstreamError
+except ImportError:
+    import api_rag
+    from albert_client import UpstreamError
+
+###########################
+# ENV CONSTS
+DEBUG = True
+
+INGESTION_STATE_FILE = "moodle_storage/ingestion_state.json" # file name -> sha256, collection and document ids
+DEBOUNCE_SECONDS = 2.0 # A file is processed once it has not changed for this long
+POLL_INTERVAL = 2.0 # Seconds between two scans of the polling watcher
+QUEUE_SIZE = 16 # Max number of files waiting between two stages
+MAX_FILE_SIZE = 20000000 # Files bigger than 20 MB are not uploaded
+STAGE_WORKERS = {"hash": 2, "extract": 2, "upload": 2, "index": 1}
+DOCUMENTS_PAGE_SIZE = 100 # Documents listed per request when rebuilding the state
+
+
+###########################
+# Watchers
+class InotifyWatcher:
+    """
+    Watch a directory with inotify (through libc), calling on_change(file_name)
+    when a file is fully written or moved into it.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, directory: str, on_change):
+        self.directory = directory
+        self.on_change = on_change
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed on {directory}")
+
+    def start(self):
+        asyncio.get_running_loop().add_reader(self.fd, self._read_events)
+
+    def stop(self):
+        asyncio.get_running_loop().remove_reader(self.fd)
+        os.close(self.fd)
+
+    def _read_events(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0").decode()
+            offset += length
+            if name:
+                self.on_change(name)
+
+
+class PollingWatcher:
+    """
+    Watch a directory by scanning it every POLL_INTERVAL seconds,
+    calling on_change(file_name) when a file appears or its size or mtime changes.
+    """
+    def __init__(self, directory: str, on_change, interval: float = POLL_INTERVAL):
+        self.directory = directory
+        self.on_change = on_change
+        self.interval = interval
+        self._snapshot = self._scan()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+    def _scan(self):
+        snapshot = dict()
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                stat = entry.stat()
+                snapshot[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            snapshot = await asyncio.to_thread(self._scan)
+            for name, signature in snapshot.items():
+                if self._snapshot.get(name) != signature:
+                    self.on_change(name)
+            self._snapshot = snapshot
+
+
+def make_watcher(directory: str, on_change):
+    """Use inotify when available, fall back to polling."""
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(directory, on_change)
+        except (OSError, AttributeError) as e:
+            print(f"inotify unavailable ({e}), falling back to polling.")
+    return PollingWatcher(directory, on_change)
+
+
+###########################
+# State
+class IngestionState(dict):
+    """
+    file name -> {"sha256", "size", "mtime_ns", "collection_id", "document_id", "indexed_at"},
+    changed from the event loop and saved from worker threads.
+    """
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.update(json.load(f))
+
+    def save(self):
+        api_rag.save_json_atomically(self.path, dict(self))
+
+_states = dict()
+
+def shared_state(path: str = None):
+    """The state stored at path, the same object for the pipeline and refresh_moodle_collection."""
+    path = path or INGESTION_STATE_FILE
+    if path not in _states:
+        _states[path] = IngestionState(path)
+    return _states[path]
+
+def describe_file(file_path: str):
+    """The fields of a state entry identifying the content of a file."""
+    stat = os.stat(file_path)
+    return {"sha256": sha256(file_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def sha256(file_path: str):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+###########################
+# Pipeline
+class IngestionPipeline:
+    def __init__(self, directory: str = None, state_file: str = None, debounce: float = DEBOUNCE_SECONDS):
+        self.directory = directory or api_rag.MOODLE_DIRECTORY
+        self.state_file = state_file
+        self.debounce = debounce
+        self.state = shared_state(state_file)
+        self.in_flight = set() # names of the files between the hash and index stages
+        self.queues = {stage: asyncio.Queue(maxsize=QUEUE_SIZE) for stage in STAGE_WORKERS}
+        self.pending = dict() # file name -> time at which it is considered stable
+        self.watcher = None
+        self.tasks = []
+        self._shard_lock = asyncio.Lock()
+        self._uploading = dict() # collection id -> number of uploads in flight
+
+    ###########################
+    # Lifecycle
+    async def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        stages = {"hash": self._hash, "extract": self._extract, "upload": self._upload, "index": self._index}
+        for stage, worker_count in STAGE_WORKERS.items():
+            for _ in range(worker_count):
+                self.tasks.append(asyncio.create_task(self._worker(stage, stages[stage])))
+        self.tasks.append(asyncio.create_task(self._flush_pending()))
+
+        # Catch up with what changed while we were not watching, the hash stage skips the rest
+        catch_up = True
+        if not self.state:
+            try:
+                await self._state_from_shards()
+            except UpstreamError as e:
+                print(f"No ingestion state and the shards could not be listed ({e}), skipping the catch-up of {self.directory}.")
+                catch_up = False
+        if catch_up:
+            for name in os.listdir(self.directory):
+                self.notify(name)
+
+        self.watcher = make_watcher(self.directory, self.notify)
+        self.watcher.start()
+        if DEBUG: print(f"Watching {self.directory} with {type(self.watcher).__name__}.")
+
+    async def stop(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def join(self):
+        """Wait until every notified file went through the pipeline."""
+        while self.pending:
+            await asyncio.sleep(0.05)
+        for stage in STAGE_WORKERS:
+            await self.queues[stage].join()
+
+    ###########################
+    # Debounce
+    def notify(self, name: str):
+        if name.endswith(".pdf"):
+            self.pending[name] = time.monotonic() + self.debounce
+
+    async def _flush_pending(self):
+        while True:
+            now = time.monotonic()
+            for name, stable_at in [(name, stable_at) for name, stable_at in self.pending.items() if stable_at <= now]:
+                # Blocks while the hash stage is full, new events for waiting files are coalesced
+                await self.queues["hash"].put(name)
+                if self.pending.get(name) == stable_at:
+                    del self.pending[name]
+            await asyncio.sleep(min(0.2, self.debounce))
+
+    async def _worker(self, stage: str, process):
+        next_stages = list(STAGE_WORKERS)
+        next_queue = None
+        if next_stages.index(stage) + 1 < len(next_stages):
+            next_queue = self.queues[next_stages[next_stages.index(stage) + 1]]
+
+        while True:
+            item = await self.queues[stage].get()
+            result = None
+            try:
+                result = await process(item)
+                if result is not None and next_queue is not None:
+                    await next_queue.put(result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Ingestion {stage} stage failed for {item if isinstance(item, str) else item['name']}: {e}")
+            finally:
+                # The file leaves the pipeline when a stage drops it or the last stage is done
+                if isinstance(item, dict) and (result is None or next_queue is None):
+                    self.in_flight.discard(item["name"])
+                self.queues[stage].task_done()
+
+    ###########################
+    # Stages
+    async def _hash(self, name: str):
+        if name in self.in_flight:
+            # The previous version is still on its way, compare against it once it is indexed
+            self.notify(name)
+            return None
+
+        file_path = os.path.join(self.directory, name)
+        if not os.path.isfile(file_path) or os.path.getsize(file_path) > MAX_FILE_SIZE:
+            return None
+
+        stat = os.stat(file_path)
+        known = self.state.get(name)
+        if known is not None and known.get("size") == stat.st_size and known.get("mtime_ns") == stat.st_mtime_ns:
+            return None
+
+        digest = await asyncio.to_thread(sha256, file_path)
+        if known is not None and known.get("sha256") == digest:
+            return None
+        self.in_flight.add(name)
+        return {"name": name, "sha256": digest, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    async def _extract(self, item: dict):
+        # Unreadable or partially written PDFs are not worth uploading, the pages are kept to map the chunks
+        item["pages"] = await asyncio.to_thread(api_rag.read_pdf_pages, item["name"], self.directory)
+        return item
+
+    async def _upload(self, item: dict):
+        collection_id = await self._choose_shard()
+        data = {"request": '{"collection": "%s"}' % collection_id}
+        try:
+            with open(os.path.join(self.directory, item["name"]), "rb") as f:
+                files = {"file": (item["name"], f, "application/pdf")}
+                response = await api_rag.albert.request("files", "POST", "/files", expected_status=(201,), data=data, files=files)
+        finally:
+            self._uploading[collection_id] -= 1
+        item["collection_id"] = collection_id
+        item["document_id"] = response.json().get("id")
+        return item
+
+    async def _index(self, item: dict):
+        # Remove the previous version of a changed file once the new one is searchable
+        previous = self.state.get(item["name"])
+        if previous is not None and previous.get("document_id") is not None:
+            try:
+                await api_rag.albert.request("documents", "DELETE", f"/documents/{previous['document_id']}", expected_status=(204, 404))
+            except UpstreamError as e:
+                print(f"Could not delete previous version of {item['name']}: {e}")
+            await asyncio.to_thread(api_rag.citation_map.remove_document, previous["document_id"])
+        await api_rag.index_citations(item["document_id"], item["name"], self.directory, item.pop("pages"))
+
+        self.state[item["name"]] = {
+            "sha256": item["sha256"],
+            "size": item["size"],
+            "mtime_ns": item["mtime_ns"],
+            "collection_id": item["collection_id"],
+            "document_id": item["document_id"],
+            "indexed_at": time.time(),
+        }
+        await asyncio.to_thread(self.state.save)
+        if DEBUG: print(f"Ingested {item['name']} into collection {item['collection_id']}.")
+        return item
+
+    ###########################
+    # Helpers
+    async def _state_from_shards(self):
+        """Record the files of the directory that already have a document in a shard."""
+        for shard in (await api_rag.get_collection_shards()).values():
+            offset = 0
+            data = []
+            while offset == 0 or len(data) == DOCUMENTS_PAGE_SIZE:
+                response = await api_rag.albert.request("documents", "GET", f"/documents?collection={shard['id']}&offset={offset}&limit={DOCUMENTS_PAGE_SIZE}")
+                data = response.json()["data"]
+                offset += DOCUMENTS_PAGE_SIZE
+                for document in data:
+                    file_path = os.path.join(self.directory, document["name"])
+                    if document["name"] not in self.state and os.path.isfile(file_path):
+                        entry = await asyncio.to_thread(describe_file, file_path)
+                        self.state[document["name"]] = dict(entry, collection_id=shard["id"], document_id=document["id"], indexed_at=time.time())
+        if self.state:
+            await asyncio.to_thread(self.state.save)
+            if DEBUG: print(f"Rebuilt the ingestion state of {len(self.state)} files from the shards.")
+
+    async def _choose_shard(self):
+        """The least filled shard with room left, or a new shard if they are all full."""
+        async with self._shard_lock:
+            shards = await api_rag.get_collection_shards()
+            ingested = dict()
+            for entry in self.state.values():
+                ingested[entry["collection_id"]] = ingested.get(entry["collection_id"], 0) + 1
+
+            # Uploads in flight are not counted by the API yet
+            counts = {i: shard.get("documents", ingested.get(shard["id"], 0)) + self._uploading.get(shard["id"], 0) for i, shard in shards.items()}
+            open_shards = [i for i in shards if counts[i] < api_rag.MAX_FILES_PER_SHARD]
+            if open_shards:
+                collection_id = shards[min(open_shards, key=lambda i: counts[i])]["id"]
+            else:
+                shard_index = max(shards) + 1 if shards else 0
+                response = await api_rag.albert.request("collections", "POST", "/collections", expected_status=(201,), json={"name": api_rag.shard_name(shard_index), "model": api_rag.EMBEDDINGS_MODEL})
+                collection_id = response.json()["id"]
+
+            self._uploading[collection_id] = self._uploading.get(collection_id, 0) + 1
+            return collection_id
+
+
+async def run_ingestion():
+    pipeline = IngestionPipeline()
+    await pipeline.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await pipeline.stop()
+
+if __name__ == "__main__":
+    asyncio.run(run_ingestion())
+    exit(1)
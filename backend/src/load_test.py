@@ -0,0 +1,162 @@
+"""
+Load generator for api_rag.root and api_basic.root.
+
+Drives the handlers in-process, either at a target rate (open loop) or with a fixed
+number of concurrent clients (closed loop), and reports throughput, latency
+percentiles and error rate. With --stub, the Albert API is replaced by the local
+stand-in from albert_stub.py so the whole run stays offline.
+
+Run from the backend directory:
+    python src/load_test.py --target rag --stub --concurrency 20 --duration 30
+    python src/load_test.py --target basic --stub --rate 50 --duration 30 --error-rate 0.05
+"""
+
+import os
+import sys
+import math
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+from collections import Counter
+
+import uvicorn
+
+DEFAULT_PROMPTS = [
+    "C'est quoi la définition d'une variable gaussienne multivariée ?",
+    "Explique le théorème central limite.",
+    "/explain Qu'est-ce qu'une chaîne de Markov ?",
+    "Quelle est la différence entre biais et variance ?",
+]
+
+###########################
+# Albert stand-in
+def start_stub(port: int, latencies: list, jitter: float, error_rate: float, error_status: int, documents: int):
+    """Start albert_stub in a background thread and point the apps at it."""
+    import albert_stub
+    albert_stub.config = albert_stub.StubConfig(
+        latencies=albert_stub.parse_latencies(latencies), jitter=jitter, error_rate=error_rate, error_status=error_status,
+    )
+    albert_stub.seed(document_count=documents)
+    server, _ = serve(albert_stub.app, port)
+
+    os.environ["ALBERT_BASE_URL"] = f"http://localhost:{port}/v1"
+    os.environ.setdefault("API_KEY", "stub")
+    return server
+
+def serve(app, port: int):
+    """Run an ASGI app with uvicorn in a background thread, return the server and the thread once started."""
+    server = uvicorn.Server(uvicorn.Config(app, host="localhost", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+###########################
+# Load generation
+def load_target(target: str):
+    """Import the app under test and return a coroutine function sending one prompt to it."""
+    if target == "rag":
+        import api_rag
+        api_rag.DEBUG = False
+        # Keep the real chat history out of the way
+        api_rag.HISTORY_FILE_NAME = os.path.join(tempfile.mkdtemp(), ".history.json")
+        return lambda prompt: api_rag.root(api_rag.Body(prompt=prompt, context=""))
+    elif target == "basic":
+        import api_basic
+        api_basic.DEBUG = False
+        return lambda prompt: api_basic.root(api_basic.Body(prompt=prompt))
+    raise ValueError(f"Unknown target '{target}'")
+
+async def timed_call(send, prompt: str, latencies: list, errors: Counter):
+    start = time.perf_counter()
+    try:
+        await send(prompt)
+    except Exception as e:
+        errors[type(e).__name__] += 1
+    else:
+        latencies.append(time.perf_counter() - start)
+
+async def run_closed_loop(send, prompts: list, concurrency: int, duration: float, latencies: list, errors: Counter):
+    """`concurrency` clients each send their next request as soon as the previous one returns."""
+    deadline = time.perf_counter() + duration
+
+    async def client(client_index: int):
+        i = client_index
+        while time.perf_counter() < deadline:
+            await timed_call(send, prompts[i % len(prompts)], latencies, errors)
+            i += concurrency
+
+    await asyncio.gather(*[client(i) for i in range(concurrency)])
+
+async def run_open_loop(send, prompts: list, rate: float, duration: float, latencies: list, errors: Counter):
+    """Requests are started every 1/rate seconds whether or not the previous ones returned."""
+    start = time.perf_counter()
+    tasks = []
+    i = 0
+    while time.perf_counter() - start < duration:
+        tasks.append(asyncio.create_task(timed_call(send, prompts[i % len(prompts)], latencies, errors)))
+        i += 1
+        await asyncio.sleep(max(0.0, start + i / rate - time.perf_counter()))
+    await asyncio.gather(*tasks)
+
+def percentile(values: list, p: float):
+    """Nearest-rank percentile of an unsorted list."""
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def report(latencies: list, errors: Counter, elapsed: float):
+    total = len(latencies) + sum(errors.values())
+    result = {
+        "requests": total,
+        "throughput": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "error_rate": sum(errors.values()) / total if total else 0.0,
+        "errors": dict(errors),
+    }
+    print(f"Requests:    {result['requests']} in {elapsed:.1f}s")
+    print(f"Throughput:  {result['throughput']:.2f} successful req/s")
+    print(f"Latency:     p50 {result['p50'] * 1000:.0f} ms, p95 {result['p95'] * 1000:.0f} ms, p99 {result['p99'] * 1000:.0f} ms")
+    print(f"Error rate:  {result['error_rate'] * 100:.2f}%" + (f" {result['errors']}" if errors else ""))
+    return result
+
+async def load_test(target: str, prompts: list, duration: float, concurrency: int = None, rate: float = None):
+    send = load_target(target)
+    latencies = []
+    errors = Counter()
+    start = time.perf_counter()
+    if rate is not None:
+        await run_open_loop(send, prompts, rate, duration, latencies, errors)
+    else:
+        await run_closed_loop(send, prompts, concurrency or 1, duration, latencies, errors)
+    return report(latencies, errors, time.perf_counter() - start)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Load test api_rag.root or api_basic.root')
+    parser.add_argument('--target', choices=['rag', 'basic'], default='rag', help='Handler to load test')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--concurrency', type=int, default=10, help='Number of concurrent clients (closed loop)')
+    mode.add_argument('--rate', type=float, help='Target request rate per second (open loop)')
+    parser.add_argument('--duration', type=float, default=30, help='Duration of the test in seconds')
+    parser.add_argument('--prompt', action='append', help='Prompt to send (repeatable), defaults to a built-in set')
+    parser.add_argument('--stub', action='store_true', help='Run against a local Albert stand-in instead of the real API')
+    parser.add_argument('--stub-port', type=int, default=8100, help='Port of the local Albert stand-in')
+    parser.add_argument('--latency', action='append', help='Stub mean latency of an endpoint, e.g. chat=0.8 (repeatable)')
+    parser.add_argument('--jitter', type=float, default=0.2, help='Stub relative latency jitter')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Stub probability of injecting an error')
+    parser.add_argument('--error-status', type=int, default=503, help='Stub status code of injected errors')
+    parser.add_argument('--documents', type=int, default=20, help='Number of synthetic documents in the stub')
+    args = parser.parse_args()
+
+    # The apps and the stub live next to this file
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    if args.stub:
+        start_stub(args.stub_port, args.latency, args.jitter, args.error_rate, args.error_status, args.documents)
+
+    asyncio.run(load_test(args.target, args.prompt or DEFAULT_PROMPTS, args.duration, args.concurrency, args.rate))
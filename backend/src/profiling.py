@@ -0,0 +1,190 @@
+"""
+On-demand request profiling for the FastAPI apps.
+
+Profiling is off unless PROFILING=1 or PROFILE_SAMPLE_RATE > 0 is set, since the
+profiles expose the internals of the server. When on, a request is profiled when it
+carries the X-Profile header, or at random with probability PROFILE_SAMPLE_RATE. While it runs, a sampling thread records the
+stack of every thread of the process (event loop, Albert client threads, file I/O
+workers) every PROFILE_INTERVAL seconds, so the profile shows wall-clock time spent
+in pdf_lines_from_chunks, pypdf, history I/O and upstream waits alike.
+
+The last MAX_PROFILES profiles are exposed by:
+    GET /admin/profiles         list of profiles with wall and CPU time
+    GET /admin/profiles/{id}    collapsed stacks ("folded" format), loadable by
+                                flamegraph.pl, speedscope or inferno
+
+A profile ends when the response body is fully sent, so streamed responses
+(/batch) include the work done while streaming.
+Samples are taken process-wide, so profiles of overlapping requests also contain
+each other's work.
+"""
+
+import os
+import sys
+import time
+import random
+import threading
+import itertools
+from collections import Counter, deque
+
+from fastapi import Request
+from fastapi.responses import PlainTextResponse, JSONResponse
+
+###########################
+# ENV CONSTS
+PROFILE_HEADER = "X-Profile"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0")) # Fraction of requests profiled without the header
+PROFILING = os.getenv("PROFILING", "0") == "1" or PROFILE_SAMPLE_RATE > 0 # Enable the header and /admin/profiles
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005")) # Seconds between two samples
+MAX_PROFILES = 20 # Number of profiles kept for /admin/profiles
+
+
+class Profile:
+    def __init__(self, profile_id: str, name: str):
+        self.id = profile_id
+        self.name = name
+        self.started = time.time()
+        self.wall_time = None
+        self.cpu_time = None
+        self.samples = Counter() # folded stack -> number of samples
+        self._start_wall = time.perf_counter()
+        self._start_cpu = time.process_time()
+
+    def stop(self):
+        self.wall_time = time.perf_counter() - self._start_wall
+        self.cpu_time = time.process_time() - self._start_cpu
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "started": self.started,
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "samples": sum(self.samples.values()),
+        }
+
+    def folded(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common()) + "\n"
+
+
+class Sampler:
+    """
+    Samples the stacks of all threads while at least one profile is active.
+    The sampling thread is started with the first active profile and exits with the last.
+    """
+    def __init__(self, interval: float = PROFILE_INTERVAL, max_profiles: int = MAX_PROFILES):
+        self.interval = interval
+        self.profiles = deque(maxlen=max_profiles)
+        self._active = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._ids = itertools.count(1)
+
+    def start(self, name: str):
+        profile = Profile(str(next(self._ids)), name)
+        with self._lock:
+            self._active.append(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+        return profile
+
+    def stop(self, profile: Profile):
+        profile.stop()
+        with self._lock:
+            self._active.remove(profile)
+            self.profiles.append(profile)
+
+    def get(self, profile_id: str):
+        for profile in self.profiles:
+            if profile.id == profile_id:
+                return profile
+        return None
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+                active = list(self._active)
+
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = self._fold(frame)
+                if stack is None:
+                    continue
+                stack = thread_names.get(thread_id, str(thread_id)) + ";" + stack
+                for profile in active:
+                    profile.samples[stack] += 1
+            time.sleep(self.interval)
+
+    def _fold(self, frame):
+        """Return the stack of a frame root first, joined with ';', or None for idle pool workers."""
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append((code.co_name, code.co_filename, frame.f_lineno))
+            frame = frame.f_back
+        frames.reverse()
+
+        # Worker threads waiting for work are not part of any request
+        loop_index = None
+        for i, (name, file_name, _) in enumerate(frames):
+            if (name == "_worker" and file_name.endswith(os.path.join("concurrent", "futures", "thread.py"))) \
+                    or (name == "run" and file_name.endswith(os.path.join("anyio", "_backends", "_asyncio.py"))):
+                loop_index = i
+        if loop_index is not None:
+            if loop_index + 1 == len(frames) or (frames[loop_index + 1][0] == "get" and frames[loop_index + 1][1].endswith("queue.py")):
+                return None
+
+        return ";".join(f"{name} ({os.path.basename(file_name)}:{line})" for name, file_name, line in frames)
+
+
+sampler = Sampler()
+
+###########################
+# FastAPI integration
+def install_profiling(app, enabled: bool = PROFILING):
+    """Profile requests on demand and expose the profiles under /admin/profiles, when enabled."""
+    if not enabled:
+        return
+
+    @app.middleware("http")
+    async def profile_request(request: Request, call_next):
+        if PROFILE_HEADER.lower() not in request.headers and random.random() >= PROFILE_SAMPLE_RATE:
+            return await call_next(request)
+
+        profile = sampler.start(f"{request.method} {request.url.path}")
+        try:
+            response = await call_next(request)
+        except BaseException:
+            sampler.stop(profile)
+            raise
+
+        # The body of a streamed response is produced after call_next returns
+        async def profiled_body(body_iterator):
+            try:
+                async for chunk in body_iterator:
+                    yield chunk
+            finally:
+                sampler.stop(profile)
+
+        response.body_iterator = profiled_body(response.body_iterator)
+        response.headers["X-Profile-Id"] = profile.id
+        return response
+
+    @app.get("/admin/profiles")
+    async def list_profiles():
+        return [profile.summary() for profile in reversed(sampler.profiles)]
+
+    @app.get("/admin/profiles/{profile_id}")
+    async def get_profile(profile_id: str):
+        profile = sampler.get(profile_id)
+        if profile is None:
+            return JSONResponse(status_code=404, content={"response": f"No profile with id {profile_id}."})
+        return PlainTextResponse(profile.folded())
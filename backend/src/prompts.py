@@ -0,0 +1,60 @@
+"""
+Prompt assembly shared by api_rag and api_basic.
+
+The system prompt and the explain prompt are loaded once. The system prompt is
+rendered once per day, so {currentDateTime} stays correct without reformatting it
+on every request.
+
+Messages are emitted stable part first, so that consecutive requests share the
+longest possible prefix and the upstream prompt/KV cache can be reused:
+    system prompt -> history -> explain prompt -> context -> RAG chunks -> user prompt
+The system prompt is shared by every request, the history by every turn of the same
+conversation (until it gets trimmed). The explain prompt only comes with /explain
+turns, so it is placed with the other per-request messages.
+"""
+
+import os
+from datetime import datetime
+from functools import lru_cache
+
+###########################
+# ENV CONSTS
+SYSTEM_PROMPT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "system_prompt.txt")
+
+EXPLAIN_PROMPT = """You are an expert in explaining concepts.
+You will be given a text and you must explain it in simple terms, as if you were explaining it to a beginner in the field.
+You must provide a clear and concise explanation.
+You must not assume anything is true before detailing why it is true.
+You must be sure to explain all the concepts in the text, even if they seem obvious.
+Take your time and explain little bit by little bit every part of the answer, especially when you introduce a new concept."""
+
+with open(SYSTEM_PROMPT_FILE, "r") as file:
+    SYSTEM_PROMPT_TEMPLATE = "".join(file.readlines())
+
+
+@lru_cache(maxsize=2)
+def _render_system_prompt(date: str):
+    return SYSTEM_PROMPT_TEMPLATE.format(currentDateTime=date)
+
+def system_prompt():
+    """
+    The system prompt with today's date.
+    """
+    return _render_system_prompt(datetime.now().strftime("%Y-%m-%d"))
+
+def build_messages(prompt: str, history: list = None, context: str = None, chunks: str = None, explain: bool = False, system: bool = True):
+    """
+    Build the chat messages in stable-prefix-first order.
+    Return the messages and the number of characters of the prefix reusable by the next
+    turn of the conversation (system prompt and history).
+    """
+    messages = []
+    if system: messages.append({"role": "system", "content": system_prompt()})
+    if history: messages.extend(history)
+    prefix_chars = sum(len(message["content"]) for message in messages)
+
+    if explain: messages.append({"role": "system", "content": EXPLAIN_PROMPT})
+    if context is not None: messages.append({"role": "context", "content": context})
+    if chunks is not None: messages.append({"role": "tool", "content": chunks})
+    messages.append({"role": "user", "content": prompt})
+    return messages, prefix_chars
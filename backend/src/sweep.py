@@ -0,0 +1,154 @@
+"""
+Offline sweep of the retrieval and history settings of api_rag.
+
+1. Record the Albert calls for a set of questions once (needs the API key):
+    python src/sweep.py record questions.json
+2. Replay them under every combination of settings, offline:
+    python src/sweep.py sweep questions.json --k 3 5 10 --cosine 0.3 0.5 0.7 --history-chars 1000 3000 --history-messages 5 20
+
+questions.json is a list of {"question": ..., "expected_file": ...}, asked in order as
+one conversation. For each combination, the sweep reports the prompt size, the
+end-to-end latency (local work plus the recorded upstream latency, waited for real)
+and how often the expected file is retrieved and located in its PDF.
+
+Completions are replayed from the recording with the same last user message when the
+prompt differs from the recorded one, so their latency does not follow the prompt size:
+use prompt_chars to compare the token cost of the settings. The "loose_chat" column gives
+the fraction of completions replayed that way.
+
+Run from the backend directory, the PDFs are read from MOODLE_DIRECTORY.
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import asyncio
+import argparse
+import itertools
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import api_rag
+import load_test
+from cassettes import CassetteAlbertClient
+from prompts import build_messages
+
+###########################
+# ENV CONSTS
+DEBUG = False
+
+
+async def ask(question: str, history: list, k: int, cosine_similarity_minimum: float, expected_file: str, pdf_cache):
+    """
+    Answer a question like api_rag.root and measure it.
+    """
+    start = time.perf_counter()
+    collection_ids = await api_rag.get_collection_ids()
+    chunks_dict_list, chunk_file_sources = await api_rag.retrieve_chunks(question, collection_ids, k, cosine_similarity_minimum)
+
+    # Locate the chunks of the expected file while the LLM generates, like /source
+    expected_chunks = [chunk for chunk in chunk_file_sources if chunk["file_name"] == expected_file]
+    locate_task = asyncio.create_task(asyncio.to_thread(locate, expected_chunks, pdf_cache))
+
+    full_chunk_rag = "\n\n\n".join([chunk_dict["content"] for chunk_dict in chunks_dict_list])
+    messages, prefix_chars = build_messages(question, history=history, context="", chunks=full_chunk_rag, system=api_rag.SYSTEM_PROMPT)
+    response = await api_rag.albert.chat_completion(model=api_rag.MODEL_NAME, messages=messages, stream=False, n=1)
+    located = await locate_task
+
+    return {
+        "answer": response.choices[0].message.content,
+        "prompt_chars": sum(len(message["content"]) for message in messages),
+        "prefix_chars": prefix_chars,
+        "latency": time.perf_counter() - start,
+        "retrieved": len(expected_chunks) > 0,
+        "located": located,
+    }
+
+def locate(chunk_file_sources: list, pdf_cache):
+    """True if at least one of the chunks was found in its PDF."""
+    if not chunk_file_sources:
+        return False
+    try:
+        line_numbers = api_rag.pdf_lines_from_chunks(chunk_file_sources, pdf_cache)
+    except Exception as e:
+        if DEBUG: print(f"Could not locate chunks in {chunk_file_sources[0]['file_name']}: {e}")
+        return False
+    return any(line is not None for line in line_numbers.values())
+
+async def run_conversation(questions: list, k: int, cosine_similarity_minimum: float, pdf_cache):
+    history = []
+    results = []
+    for question in questions:
+        result = await ask(question["question"], history, k, cosine_similarity_minimum, question.get("expected_file"), pdf_cache)
+        history = api_rag.append_history(list(history), question["question"], result["answer"])
+        results.append(result)
+    return results
+
+###########################
+# Modes
+async def record(questions: list, max_k: int):
+    """Record every call needed to replay the questions with any k up to max_k."""
+    await run_conversation(questions, max_k, 0.0, api_rag.PdfCache())
+    print(f"Recorded {len(api_rag.albert.cassettes)} calls in {api_rag.albert.directory}.")
+
+async def sweep(questions: list, ks: list, cosines: list, history_chars: list, history_messages: list, out: str = None):
+    pdf_cache = api_rag.PdfCache() # Shared by all combinations, each PDF is parsed once
+    rows = []
+    for k, cosine, max_chars, max_messages in itertools.product(ks, cosines, history_chars, history_messages):
+        api_rag.MAX_HISTORY_CHARS = max_chars
+        api_rag.MAX_MESSAGES_HISTORY = max_messages
+        loose_replays = api_rag.albert.loose_replays
+        results = await run_conversation(questions, k, cosine, pdf_cache)
+        latencies = [result["latency"] for result in results]
+        rows.append({
+            "k": k,
+            "cosine": cosine,
+            "history_chars": max_chars,
+            "history_messages": max_messages,
+            "prompt_chars": sum(result["prompt_chars"] for result in results) / len(results),
+            "prefix_chars": sum(result["prefix_chars"] for result in results) / len(results),
+            "p50_ms": load_test.percentile(latencies, 50) * 1000,
+            "p95_ms": load_test.percentile(latencies, 95) * 1000,
+            "retrieved": sum(result["retrieved"] for result in results) / len(results),
+            "located": sum(result["located"] for result in results) / len(results),
+            "loose_chat": (api_rag.albert.loose_replays - loose_replays) / len(results),
+        })
+
+    columns = list(rows[0].keys())
+    print(" ".join(f"{column:>16}" for column in columns))
+    for row in rows:
+        print(" ".join(f"{row[column]:>16.2f}" if isinstance(row[column], float) else f"{row[column]:>16}" for column in columns))
+    if any(row["loose_chat"] > 0 for row in rows):
+        print("Note: completions with loose_chat > 0 replay the chat time recorded for another prompt size, "
+              "their latency does not reflect the prompt size, compare prompt_chars instead.")
+
+    if out is not None:
+        with open(out, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Record Albert calls for a set of questions, then sweep the retrieval and history settings offline')
+    parser.add_argument('mode', choices=['record', 'sweep'], help='Record the calls, or replay them under every combination of settings')
+    parser.add_argument('questions', help='JSON list of {"question", "expected_file"}')
+    parser.add_argument('--cassettes', default=api_rag.CASSETTE_DIR, help='Directory of the recorded calls')
+    parser.add_argument('--k', type=int, nargs='+', default=[5], help='Number of chunks retrieved')
+    parser.add_argument('--cosine', type=float, nargs='+', default=[0.5], help='Minimum cosine similarity of a chunk')
+    parser.add_argument('--history-chars', type=int, nargs='+', default=[api_rag.MAX_HISTORY_CHARS], help='MAX_HISTORY_CHARS values')
+    parser.add_argument('--history-messages', type=int, nargs='+', default=[api_rag.MAX_MESSAGES_HISTORY], help='MAX_MESSAGES_HISTORY values')
+    parser.add_argument('--latency-scale', type=float, default=1.0, help='Fraction of the recorded upstream latency waited when replaying')
+    parser.add_argument('--out', help='Write the sweep results to this CSV file')
+    args = parser.parse_args()
+
+    with open(args.questions, "r", encoding="utf-8") as f:
+        questions = json.load(f)
+
+    api_rag.DEBUG = DEBUG
+    api_rag.albert = CassetteAlbertClient(api_rag.BASE_URL, api_rag.API_KEY, args.mode if args.mode == "record" else "replay", args.cassettes, args.latency_scale)
+    if args.mode == "record":
+        asyncio.run(record(questions, max(args.k)))
+    else:
+        asyncio.run(sweep(questions, args.k, args.cosine, args.history_chars, args.history_messages, args.out))
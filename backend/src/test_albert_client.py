@@ -0,0 +1,156 @@
+# test file for albert_client.py
+
+import time
+import asyncio
+import requests
+import albert_client
+from albert_client import AlbertClient, EndpointPolicy, UpstreamError, CircuitOpenError, OverloadedError
+
+albert_client.DEBUG = False
+
+def make_client(**policy):
+  return AlbertClient("http://albert.invalid", "key", policies={"test": EndpointPolicy(backoff_base=0, **policy)})
+
+def test_retry_then_success():
+  client = make_client(max_attempts=3)
+  calls = []
+  def fn(timeout):
+    calls.append(timeout)
+    if len(calls) < 3:
+      raise requests.ConnectionError("down")
+    return "ok"
+  assert asyncio.run(client.call("test", fn, idempotent=True)) == "ok"
+  assert len(calls) == 3
+
+def test_no_retry_when_not_idempotent():
+  client = make_client(max_attempts=3)
+  calls = []
+  def fn(timeout):
+    calls.append(timeout)
+    raise requests.Timeout("slow")
+  try:
+    asyncio.run(client.call("test", fn, idempotent=False))
+    assert False
+  except UpstreamError:
+    pass
+  assert len(calls) == 1
+
+def test_circuit_opens():
+  client = make_client(max_attempts=1, failure_threshold=2, reset_timeout=60)
+  def fn(timeout):
+    raise UpstreamError("test", "503", 503)
+  for _ in range(2):
+    try:
+      asyncio.run(client.call("test", fn, idempotent=True))
+    except CircuitOpenError:
+      assert False
+    except UpstreamError:
+      pass
+  try:
+    asyncio.run(client.call("test", fn, idempotent=True))
+    assert False
+  except CircuitOpenError as e:
+    assert 59 < e.retry_after <= 60
+
+def test_load_shedding():
+  client = make_client(initial_limit=1, max_queue=1, queue_timeout=5)
+  async def run():
+    release = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    def fn(timeout):
+      asyncio.run_coroutine_threadsafe(release.wait(), loop).result()
+      return "ok"
+    first = asyncio.create_task(client.call("test", fn, idempotent=True))
+    second = asyncio.create_task(client.call("test", fn, idempotent=True))
+    await asyncio.sleep(0.05)
+    try:
+      await client.call("test", fn, idempotent=True)
+      assert False
+    except OverloadedError:
+      pass
+    release.set()
+    assert await first == "ok" and await second == "ok"
+  asyncio.run(run())
+
+def test_cancelled_call_keeps_its_slot():
+  client = make_client(initial_limit=8)
+  async def run():
+    release = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    def fn(timeout):
+      asyncio.run_coroutine_threadsafe(release.wait(), loop).result()
+      return "ok"
+    for _ in range(3):
+      try:
+        await asyncio.wait_for(client.call("test", fn, idempotent=True), 0.05)
+        assert False
+      except asyncio.TimeoutError:
+        pass
+    limiter = client.limiters["test"]
+    assert limiter.inflight == 3 and limiter.limit == 8
+    release.set()
+    await asyncio.sleep(0.1)
+    assert limiter.inflight == 0 and limiter.limit == 8
+  asyncio.run(run())
+
+def test_chat_limit_ignores_slow_answers():
+  limiter = albert_client.AdaptiveLimiter("chat", albert_client.DEFAULT_POLICIES["chat"])
+  for latency in [1.0, 9.0, 4.0, 10.0] * 25:
+    limiter.inflight += 1
+    limiter.release(latency, ok=True)
+  assert limiter.limit >= albert_client.DEFAULT_POLICIES["chat"].initial_limit
+
+def test_deadline_cuts_attempts():
+  client = make_client(timeout=10, max_attempts=3)
+  timeouts = []
+  def fn(timeout):
+    timeouts.append(timeout)
+    time.sleep(timeout)
+    raise requests.Timeout("slow")
+  start = time.monotonic()
+  try:
+    asyncio.run(client.call("test", fn, idempotent=True, deadline=0.2))
+    assert False
+  except UpstreamError:
+    pass
+  assert time.monotonic() - start < 1 and len(timeouts) == 1 and timeouts[0] <= 0.2
+  assert client.breakers["test"].failures == 1
+
+def test_deadline_includes_queue_wait():
+  client = make_client(timeout=10, initial_limit=1, queue_timeout=10)
+  async def run():
+    release = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    def busy(timeout):
+      asyncio.run_coroutine_threadsafe(release.wait(), loop).result()
+      return "ok"
+    first = asyncio.create_task(client.call("test", busy, idempotent=True))
+    await asyncio.sleep(0.05)
+    start = time.monotonic()
+    try:
+      await client.call("test", lambda timeout: "ok", idempotent=True, deadline=0.3)
+      assert False
+    except (OverloadedError, UpstreamError):
+      pass
+    elapsed = time.monotonic() - start
+    release.set()
+    await first
+    return elapsed
+  assert asyncio.run(run()) < 0.5
+
+def test_deadline_timeout_recomputed_after_queue():
+  client = make_client(timeout=10, initial_limit=1)
+  async def run():
+    async def busy():
+      await client.call("test", lambda timeout: time.sleep(0.3), idempotent=True)
+    first = asyncio.create_task(busy())
+    await asyncio.sleep(0.05)
+    timeouts = []
+    await client.call("test", timeouts.append, idempotent=True, deadline=1.0)
+    await first
+    return timeouts[0]
+  assert asyncio.run(run()) <= 0.8
+
+def test_connection_pool_fits_worker_threads():
+  adapter = make_client().session.get_adapter("https://albert.invalid")
+  assert adapter._pool_maxsize == albert_client.UPSTREAM_THREADS
@@ -0,0 +1,38 @@
+# test file for albert_stub.py
+
+import json
+from fastapi.testclient import TestClient
+import albert_stub
+
+albert_stub.config = albert_stub.StubConfig(latencies={}, jitter=0.0)
+client = TestClient(albert_stub.app)
+
+def test_collections_files_search():
+  collection_id = client.post("/v1/collections", json={"name": "moodle_pdfs_0", "model": "embeddings-small"}).json()["id"]
+  files = {"file": ("cours.pdf", b"%PDF-1.4", "application/pdf")}
+  data = {"request": '{"collection": "%s"}' % collection_id}
+  assert client.post("/v1/files", data=data, files=files).status_code == 201
+
+  names = [c["name"] for c in client.get("/v1/collections").json()["data"]]
+  assert "moodle_pdfs_0" in names
+
+  results = client.post("/v1/search", json={"collections": [collection_id], "k": 3, "prompt": "test", "method": "semantic"}).json()["data"]
+  assert len(results) == 3
+  assert results[0]["chunk"]["metadata"]["document_name"] == "cours.pdf"
+  assert client.delete(f"/v1/collections/{collection_id}").status_code == 204
+
+def test_chat_completions_stream():
+  body = {"model": "albert-small", "messages": [{"role": "user", "content": "hi"}], "stream": True}
+  content = ""
+  with client.stream("POST", "/v1/chat/completions", json=body) as response:
+    for line in response.iter_lines():
+      if line.startswith("data: ") and line != "data: [DONE]":
+        content += json.loads(line[len("data: "):])["choices"][0]["delta"].get("content", "")
+  assert content == albert_stub.STUB_ANSWER
+
+def test_error_injection():
+  albert_stub.config = albert_stub.StubConfig(latencies={}, jitter=0.0, error_rate=1.0, error_status=502)
+  try:
+    assert client.get("/v1/collections").status_code == 502
+  finally:
+    albert_stub.config = albert_stub.StubConfig(latencies={}, jitter=0.0)
@@ -1,12 +1,85 @@
 # test file for api_rag.py
 
+import json
+import asyncio
 import api_rag
+import albert_stub
 
 async def test_rag():
   prompt = "/source C'est quoi la définition d'une variable gaussienne multivariée ?"
   res = await api_rag.root(api_rag.Body(prompt=prompt, context=""))
   print(res["response"])
 
+def test_rag_batch(stub_rag, monkeypatch):
+  parsed = []
+  def read_pdf(file_name, directory=None):
+    parsed.append(file_name)
+    return "Stub content\n"
+  monkeypatch.setattr(api_rag, "read_pdf", read_pdf)
+  albert_stub.seed(document_count=1)
+
+  prompts = [
+    "/source C'est quoi la définition d'une variable gaussienne multivariée ?",
+    "/source Explique le théorème central limite.",
+    "/find matrice de covariance",
+    "/reset",
+    "/explain Qu'est-ce qu'une chaîne de Markov ?",
+  ]
+  async def run():
+    response = await api_rag.batch(api_rag.BodyBatch(prompts=prompts))
+    return [json.loads(line) async for line in response.body_iterator]
+  items = asyncio.run(run())
+
+  assert len(items) == len(prompts)
+  assert sorted(item["index"] for item in items) == list(range(len(prompts)))
+  by_index = {item["index"]: item for item in items}
+  assert all("error" not in item for item in items)
+  assert "not available in batches" in by_index[3]["response"]
+  assert "Sources used" in by_index[0]["response"] and "stub_document_0.pdf" in by_index[2]["response"]
+  assert parsed == ["stub_document_0.pdf"]
+
+def test_pdf_lines_keyed_by_document():
+  pdf_cache = api_rag.PdfCache()
+  pdf_cache.pdfs["a.pdf"] = api_rag.alpha_content("Titre\nAlpha\n")
+  pdf_cache.pdfs["b.pdf"] = api_rag.alpha_content("Titre\nUn\nDeux\nBeta\n")
+  chunk_file_sources = [
+    {"file_name": "a.pdf", "document_id": 1, "chunk_id": 1, "content": "Alpha"},
+    {"file_name": "b.pdf", "document_id": 2, "chunk_id": 1, "content": "Beta"},
+  ]
+  lines = api_rag.pdf_lines_from_chunks(chunk_file_sources, pdf_cache)
+  assert lines[(1, 1)] != lines[(2, 1)]
+  assert pdf_cache.lines == lines
+
+def test_citation_map(stub_rag, monkeypatch):
+
+  # Chunk ids are numbered within each document, so both documents have a chunk 1
+  collection_id = albert_stub.seed("moodle_pdfs_0", document_count=0)
+  graphes_pages = ["Les graphes\nUn graphe est un ensemble de sommets", "reliés par des arêtes.\nUn arbre est un graphe connexe sans cycle."]
+  graphes = albert_stub.add_document(collection_id, "graphes.pdf", contents=["Un graphe est un ensemble de sommets", "Un arbre est un graphe connexe sans cycle.", "Une chaîne de Markov"])
+  arbres = albert_stub.add_document(collection_id, "arbres.pdf", contents=["Une forêt est un ensemble d'arbres"])
+  citations = asyncio.run(api_rag.index_citations(graphes, "graphes.pdf", pages=graphes_pages))
+  citations.update(asyncio.run(api_rag.index_citations(arbres, "arbres.pdf", pages=["Titre\n\nIntro\nUne forêt est un ensemble d'arbres"])))
+  assert {key: (c["page"], c["line"]) for key, c in citations.items()} == {
+    (graphes, 1): (1, 1), (graphes, 2): (2, 1), (graphes, 3): (None, None), (arbres, 1): (1, 2),
+  }
+
+  # Mapped chunks are looked up from the reloaded map, unmapped or mismatched chunks fall back on the PDF
+  monkeypatch.setattr(api_rag, "citation_map", api_rag.CitationMap(api_rag.citation_map.path))
+  pdf_cache = api_rag.PdfCache()
+  pdf_cache.pdfs["autre.pdf"] = api_rag.alpha_content("Titre\nUn autre cours\n")
+  chunk_file_sources = [{"file_name": "graphes.pdf", "document_id": graphes, "chunk_id": chunk_id, "content": ""} for chunk_id in (1, 2, 3)]
+  chunk_file_sources.append({"file_name": "arbres.pdf", "document_id": arbres, "chunk_id": 1, "content": ""})
+  assert api_rag.sources_from_chunks(chunk_file_sources, pdf_cache) == [
+    "File: graphes.pdf, page 1, around line 1.",
+    "File: graphes.pdf, page 2, around line 1.",
+    "File: graphes.pdf, line not found (common in LaTeX pdfs).",
+    "File: arbres.pdf, page 1, around line 2.",
+  ]
+  # A stale entry, mapped for another file under the same ids
+  stale = [{"file_name": "autre.pdf", "document_id": graphes, "chunk_id": 1, "content": "Un autre cours"}]
+  assert api_rag.sources_from_chunks(stale, pdf_cache) == ["File: autre.pdf, around line 1."]
+  assert list(pdf_cache.pdfs) == ["autre.pdf"]
+
 if __name__ == "__main__":
   import asyncio
   asyncio.run(test_rag())
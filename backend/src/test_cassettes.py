@@ -0,0 +1,35 @@
+# test file for cassettes.py
+
+import asyncio
+import tempfile
+import pytest
+import albert_stub
+import cassettes
+
+cassettes.DEBUG = False
+
+def test_record_then_replay(albert_stub_url):
+  directory = tempfile.mkdtemp()
+  collection_id = albert_stub.seed(document_count=3)
+  search = {"collections": [collection_id], "k": 5, "prompt": "test", "method": "semantic"}
+  chat = {"model": "albert-small", "messages": [{"role": "user", "content": "hi"}], "stream": False, "n": 1}
+
+  async def run(client, k):
+    response = await client.request("search", "POST", "/search", json=dict(search, k=k))
+    completion = await client.chat_completion(**chat)
+    return response.json()["data"], completion.choices[0].message.content
+
+  recorded = asyncio.run(run(cassettes.CassetteAlbertClient(albert_stub_url, "stub", "record", directory), 5))
+
+  assert len(recorded[0]) == 5
+
+  # Offline: smaller k is a prefix of the recorded search, other messages fall back on the last user message
+  replay = cassettes.CassetteAlbertClient("http://localhost:1/v1", "stub", "replay", directory)
+  assert asyncio.run(run(replay, 5)) == recorded
+  assert asyncio.run(run(replay, 2))[0] == recorded[0][:2]
+  chat["messages"] = [{"role": "system", "content": "other"}] + chat["messages"]
+  assert asyncio.run(run(replay, 5))[1] == recorded[1]
+  assert replay.loose_replays == 1
+
+  with pytest.raises(cassettes.CassetteMissError):
+    asyncio.run(replay.request("collections", "GET", "/collections"))
@@ -0,0 +1,82 @@
+# test file for ingestion.py
+
+import os
+import asyncio
+import tempfile
+import api_rag
+import albert_stub
+import ingestion
+
+ingestion.DEBUG = False
+
+def test_watchers_see_new_files():
+  async def run(make):
+    directory = tempfile.mkdtemp()
+    seen = []
+    watcher = make(directory, seen.append)
+    watcher.start()
+    with open(os.path.join(directory, "cours.pdf"), "wb") as f:
+      f.write(b"%PDF-1.4")
+    await asyncio.sleep(0.3)
+    watcher.stop()
+    return seen
+  assert "cours.pdf" in asyncio.run(run(ingestion.make_watcher))
+  assert "cours.pdf" in asyncio.run(run(lambda d, cb: ingestion.PollingWatcher(d, cb, interval=0.05)))
+
+def test_debounce_coalesces_bursts():
+  async def run():
+    pipeline = ingestion.IngestionPipeline(tempfile.mkdtemp(), os.path.join(tempfile.mkdtemp(), "state.json"), debounce=0.1)
+    flush = asyncio.create_task(pipeline._flush_pending())
+    for _ in range(50):
+      pipeline.notify("cours.pdf")
+      pipeline.notify("notes.txt")
+      await asyncio.sleep(0.005)
+    await asyncio.sleep(0.4)
+    flush.cancel()
+    return pipeline.queues["hash"].qsize(), pipeline.queues["hash"].get_nowait()
+  assert asyncio.run(run()) == (1, "cours.pdf")
+
+def test_file_in_flight_is_not_processed_twice():
+  async def run():
+    directory = tempfile.mkdtemp()
+    with open(os.path.join(directory, "cours.pdf"), "wb") as f:
+      f.write(b"%PDF-1.4 v1")
+    pipeline = ingestion.IngestionPipeline(directory, os.path.join(tempfile.mkdtemp(), "state.json"), debounce=0.1)
+    first = await pipeline._hash("cours.pdf")
+    with open(os.path.join(directory, "cours.pdf"), "wb") as f:
+      f.write(b"%PDF-1.4 v2")
+    second = await pipeline._hash("cours.pdf")
+    return first, second, pipeline
+  first, second, pipeline = asyncio.run(run())
+  assert first["name"] == "cours.pdf" and second is None
+  assert "cours.pdf" in pipeline.pending and "cours.pdf" in pipeline.in_flight
+
+def test_refresh_shares_the_state(stub_rag, monkeypatch):
+  directory = tempfile.mkdtemp()
+  with open(os.path.join(directory, "cours.pdf"), "wb") as f:
+    f.write(b"%PDF-1.4")
+  monkeypatch.setattr(ingestion, "INGESTION_STATE_FILE", os.path.join(tempfile.mkdtemp(), "state.json"))
+  monkeypatch.setattr(api_rag, "MOODLE_DIRECTORY", directory)
+
+  async def run():
+    await api_rag.refresh_moodle_collection([])
+    pipeline = ingestion.IngestionPipeline(directory)
+    return await pipeline._hash("cours.pdf")
+  assert asyncio.run(run()) is None
+  assert ingestion.IngestionState(ingestion.INGESTION_STATE_FILE)["cours.pdf"]["document_id"] is not None
+
+def test_missing_state_is_rebuilt_from_the_shards(stub_rag):
+  directory = tempfile.mkdtemp()
+  for name in ("cours.pdf", "nouveau.pdf"):
+    with open(os.path.join(directory, name), "wb") as f:
+      f.write(b"%PDF-1.4")
+  document_id = albert_stub.add_document(albert_stub.seed(document_count=0), "cours.pdf")
+
+  async def run():
+    pipeline = ingestion.IngestionPipeline(directory, os.path.join(tempfile.mkdtemp(), "state.json"), debounce=60)
+    await pipeline.start()
+    await pipeline.stop()
+    return pipeline, await pipeline._hash("cours.pdf"), await pipeline._hash("nouveau.pdf")
+  pipeline, known, new = asyncio.run(run())
+  assert known is None and new["name"] == "nouveau.pdf"
+  assert ingestion.IngestionState(pipeline.state.path)["cours.pdf"]["document_id"] == document_id
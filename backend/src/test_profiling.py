@@ -0,0 +1,54 @@
+# test file for profiling.py
+
+import time
+import asyncio
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+import profiling
+
+app = FastAPI()
+profiling.install_profiling(app, enabled=True)
+
+def slow_parsing():
+  time.sleep(0.1)
+
+@app.post("/")
+async def root():
+  await asyncio.to_thread(slow_parsing)
+  return {"response": "ok"}
+
+@app.post("/stream")
+async def stream():
+  async def lines():
+    for _ in range(2):
+      await asyncio.to_thread(slow_parsing)
+      yield "ok\n"
+  return StreamingResponse(lines())
+
+client = TestClient(app)
+
+def test_profile_on_header():
+  assert "X-Profile-Id" not in client.post("/").headers
+  response = client.post("/", headers={"X-Profile": "1"})
+  profile_id = response.headers["X-Profile-Id"]
+
+  summary = [p for p in client.get("/admin/profiles").json() if p["id"] == profile_id][0]
+  assert summary["wall_time"] >= 0.1 and summary["samples"] > 0
+
+  folded = client.get(f"/admin/profiles/{profile_id}").text
+  assert any("slow_parsing" in line and line.rsplit(" ", 1)[1].isdigit() for line in folded.splitlines())
+
+def test_unknown_profile():
+  assert client.get("/admin/profiles/unknown").status_code == 404
+
+def test_profile_covers_streamed_body():
+  profile_id = client.post("/stream", headers={"X-Profile": "1"}).headers["X-Profile-Id"]
+  summary = [p for p in client.get("/admin/profiles").json() if p["id"] == profile_id][0]
+  assert summary["wall_time"] >= 0.2
+  assert "slow_parsing" in client.get(f"/admin/profiles/{profile_id}").text
+
+def test_disabled_by_default():
+  disabled = FastAPI()
+  profiling.install_profiling(disabled, enabled=False)
+  assert TestClient(disabled).get("/admin/profiles").status_code == 404
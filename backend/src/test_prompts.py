@@ -0,0 +1,20 @@
+# test file for prompts.py
+
+import prompts
+
+def test_stable_prefix_first():
+  history = [{"role": "user", "content": "q1"}, {"role": "assistant", "content": "a1"}]
+  first, first_prefix = prompts.build_messages("q2", history=history, context="ctx", chunks="chunks", explain=True)
+  second, second_prefix = prompts.build_messages("q3", history=history, context="other", chunks="other chunks", explain=False)
+
+  assert [m["role"] for m in first] == ["system", "user", "assistant", "system", "context", "tool", "user"]
+  assert first_prefix == second_prefix == sum(len(m["content"]) for m in first[:3])
+  assert first[:3] == second[:3]
+  assert first[3]["content"] == prompts.EXPLAIN_PROMPT
+  assert first[-1] == {"role": "user", "content": "q2"}
+
+def test_system_prompt_date():
+  prompts._render_system_prompt.cache_clear()
+  assert "{currentDateTime}" not in prompts.system_prompt()
+  assert prompts.system_prompt() is prompts.system_prompt()
+  assert "1999-12-31" in prompts._render_system_prompt("1999-12-31")